@@ -4,9 +4,14 @@ import numpy as np
 from PIL import Image
 import pickle
 import glob
+import time
 
 from visioncop.models import get_image_embedding
 from visioncop.verification import verify_image_authenticity, get_verification_status
+from visioncop.thumbnails import get_derivative
+from visioncop.ingest import ingest_chunks, read_chunks
+from visioncop.database import init_database, get_embeddings_by_filename, get_image_hashes, get_exif_records
+from visioncop.jobs import enqueue_images, get_job, get_job_filenames
 
 # Paths
 DATA_DIR = "visioncop/data/images"
@@ -15,6 +20,11 @@ EMBEDDINGS_FILE = "visioncop/data/embeddings.pkl"
 # Create directories
 os.makedirs(DATA_DIR, exist_ok=True)
 
+def load_thumbnail(file_path):
+    """Open the cached thumbnail for a result tile, falling back to the original"""
+    thumb_path, _ = get_derivative(file_path, 'thumb')
+    return Image.open(thumb_path or file_path)
+
 def load_embeddings():
     """Load stored image embeddings"""
     if os.path.exists(EMBEDDINGS_FILE):
@@ -27,18 +37,38 @@ def save_embeddings(embeddings):
     with open(EMBEDDINGS_FILE, 'wb') as f:
         pickle.dump(embeddings, f)
 
-def index_image(file_path, filename):
-    """Index a single image"""
-    try:
-        embedding = get_image_embedding(file_path)
-        if embedding is not None:
-            embeddings = load_embeddings()
-            embeddings[filename] = embedding
-            save_embeddings(embeddings)
-            return True
-    except Exception as e:
-        print(f"Error indexing {filename}: {e}")
-    return False
+def sync_job_embeddings(job_id):
+    """Copy embeddings indexed by a background job into the local store"""
+    filenames = get_job_filenames(job_id)
+    if not filenames:
+        return 0
+
+    embeddings = load_embeddings()
+    embeddings.update(get_embeddings_by_filename(filenames))
+    save_embeddings(embeddings)
+    return len(filenames)
+
+def wait_for_job(job_id, progress_bar, status_text, stall_timeout=60):
+    """Poll a background indexing job, updating the progress widgets"""
+    last_progress = None
+    last_change = time.time()
+
+    while True:
+        job = get_job(job_id)
+        progress_bar.progress(job['progress'])
+        status_text.text(f"Indexing {job['completed'] + job['failed']}/{job['total']} "
+                         f"({job['images_per_second']} img/s)...")
+
+        if job['status'] in ('done', 'failed'):
+            return job
+
+        if job['progress'] != last_progress:
+            last_progress = job['progress']
+            last_change = time.time()
+        elif time.time() - last_change > stall_timeout:
+            return job
+
+        time.sleep(0.5)
 
 def find_similar_images(query_embedding, top_k=6):
     """Find similar images using cosine similarity"""
@@ -115,12 +145,18 @@ def main():
                                     # Verify against ALL indexed images
                                     all_verifications = []
 
+                                    # pHashes stored by the dedup job save decoding each candidate
+                                    stored_hashes = get_image_hashes()
+                                    stored_exif = get_exif_records()
+
                                     # Get list of all indexed images
                                     for image_file in os.listdir("visioncop/data/images"):
                                         if image_file.endswith(('.jpg', '.jpeg', '.png')):
                                             image_path = f"visioncop/data/images/{image_file}"
                                             try:
-                                                verification = verify_image_authenticity(temp_path, image_path)
+                                                stored_hash = stored_hashes.get(image_file, {}).get('phash')
+                                                verification = verify_image_authenticity(temp_path, image_path, original_hash=stored_hash,
+                                                                                         original_exif=stored_exif.get(image_file))
                                                 if verification['pixel_distance'] >= 0:  # Successful verification
                                                     all_verifications.append((image_file, verification))
                                             except:
@@ -141,7 +177,7 @@ def main():
                                                 file_path = f"visioncop/data/images/{filename}"
                                                 if os.path.exists(file_path):
                                                     try:
-                                                        img = Image.open(file_path)
+                                                        img = load_thumbnail(file_path)
                                                         confidence, color = get_verification_status(verification)
 
                                                         caption = f"{filename}\n🔒 {confidence}"
@@ -187,7 +223,7 @@ def main():
                                         file_path = f"visioncop/data/images/{filename}"
                                         if os.path.exists(file_path):
                                             try:
-                                                img = Image.open(file_path)
+                                                img = load_thumbnail(file_path)
                                                 caption = f"{filename}\n🎯 Similarity: {(similarity*100):.1f}%"
 
                                                 st.image(img, caption=caption, width=150)
@@ -210,7 +246,7 @@ def main():
 
                                             col1, col2 = st.columns([1, 3])
                                             with col1:
-                                                img = Image.open(file_path)
+                                                img = load_thumbnail(file_path)
                                                 st.image(img, width=100)
 
                                             with col2:
@@ -272,29 +308,30 @@ def main():
                 progress_bar = st.progress(0)
                 status_text = st.empty()
 
-                successes = 0
                 total = len(uploaded_files)
+                items = []
 
-                for i, uploaded_file in enumerate(uploaded_files):
+                for uploaded_file in uploaded_files:
                     try:
-                        status_text.text(f"Processing {uploaded_file.name}...")
-
-                        # Save file and index
-                        file_path = os.path.join(DATA_DIR, uploaded_file.name)
-                        with open(file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
-
-                        # Index the image
-                        if index_image(file_path, uploaded_file.name):
-                            successes += 1
-                        else:
-                            st.error(f"Failed to index {uploaded_file.name}")
-
+                        # Stream file to disk in chunks, validating as it goes
+                        upload = ingest_chunks(read_chunks(uploaded_file), DATA_DIR, filename=uploaded_file.name)
+                        items.append({'filename': upload['filename'], 'path': upload['path'],
+                                      'metadata': {'source': 'upload', 'sha256': upload['sha256']}})
+                    except ValueError as e:
+                        st.error(f"Rejected {uploaded_file.name}: {e}")
                     except Exception as e:
                         st.error(f"Error processing {uploaded_file.name}: {e}")
 
-                    progress = (i + 1) / total
-                    progress_bar.progress(progress)
+                successes = 0
+                if items:
+                    # Index in background workers and poll the job's progress
+                    init_database()
+                    job_id = enqueue_images(items)
+                    job = wait_for_job(job_id, progress_bar, status_text)
+
+                    for error in job['errors']:
+                        st.error(f"Failed to index {error}")
+                    successes = sync_job_embeddings(job_id)
 
                 progress_bar.empty()
                 status_text.empty()
@@ -306,6 +343,9 @@ def main():
                 if successes > 0:
                     st.success(f"✅ Successfully indexed {successes}/{total} images!")
                     st.balloons()
+                elif items and job['status'] in ('queued', 'running'):
+                    st.warning("⏳ Images are queued but no index worker is making progress. "
+                               "Check the worker log for errors, or start one with: python run.py --index-workers 1")
                 else:
                     st.error("❌ No images were successfully indexed.")
 
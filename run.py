@@ -6,16 +6,52 @@ Simple startup script
 Run from project root: python run.py
 """
 
+import argparse
 import subprocess
 import sys
 import os
+import time
 
-def start_streamlit():
+def start_index_workers(count):
+    """Start background index worker processes for the job queue"""
+    if count <= 0:
+        return []
+
+    from visioncop.jobs import start_workers
+
+    print(f"⚙️ Starting {count} index worker(s)")
+    return start_workers(count)
+
+def stop_index_workers(workers):
+    """Stop background index workers"""
+    if not workers:
+        return
+
+    from visioncop.jobs import stop_workers
+
+    stop_workers(workers)
+
+def run_index_workers(count):
+    """Run index workers in the foreground until Ctrl+C"""
+    print("⚙️ VisionCOP Index Workers")
+    print("⏹️  Press Ctrl+C to stop\n")
+
+    workers = start_index_workers(count)
+    try:
+        # Workers that die are restarted by the supervisor in start_workers
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_index_workers(workers)
+        print("\n👋 Index workers stopped")
+
+def start_streamlit(index_workers=1):
     """Start the Streamlit app"""
     print("🚀 Starting VisionCOP Server...")
     print("📱 Web interface: http://localhost:8501")
     print("⏹️  Press Ctrl+C to stop\n")
 
+    workers = start_index_workers(index_workers)
     try:
         # Run streamlit app
         cmd = [sys.executable, "-m", "streamlit", "run", "app.py", "--server.headless=true", "--server.port=8501"]
@@ -24,6 +60,35 @@ def start_streamlit():
         print("\n👋 VisionCOP stopped")
     except Exception as e:
         print(f"❌ Error starting server: {e}")
+    finally:
+        stop_index_workers(workers)
+
+def start_api_server(workers=None, port=8000, index_workers=1):
+    """Start the FastAPI service with multiple workers"""
+    workers = workers or max(1, (os.cpu_count() or 1) // 2)
+
+    print(f"🚀 Starting VisionCOP API with {workers} workers...")
+    print(f"🌐 API: http://localhost:{port}")
+    print("⏹️  Press Ctrl+C to stop\n")
+
+    env = dict(os.environ)
+    # Load ResNet50 in the master so forked workers share its weights
+    env["VISIONCOP_PRELOAD_MODEL"] = "1"
+    # Split CPU threads between workers instead of oversubscribing
+    env.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+
+    background_workers = start_index_workers(index_workers)
+    try:
+        cmd = [sys.executable, "-m", "gunicorn", "visioncop.app:app",
+               "--worker-class", "uvicorn.workers.UvicornWorker",
+               "--workers", str(workers), "--bind", f"0.0.0.0:{port}", "--preload"]
+        subprocess.run(cmd, cwd=os.getcwd(), env=env)
+    except KeyboardInterrupt:
+        print("\n👋 VisionCOP stopped")
+    except Exception as e:
+        print(f"❌ Error starting server: {e}")
+    finally:
+        stop_index_workers(background_workers)
 
 def load_mirflickr():
     """Load MIRFLICKR dataset from ZIP file"""
@@ -32,12 +97,6 @@ def load_mirflickr():
     print("Make sure the mirflickr.zip file is in the project root directory")
     print("Use: python run.py --load-mirflickr\n")
 
-    import zipfile
-    import pandas as pd
-    from visioncop.models import get_image_embedding
-    from visioncop.database import add_image
-    import json
-
     zip_path = "mirflickr.zip"
     extract_path = "visioncop/data/images"
 
@@ -47,6 +106,12 @@ def load_mirflickr():
         print("MIRFLICKR can be found at: https://press.liacs.nl/mirflickr/")
         return
 
+    import zipfile
+    from datetime import datetime
+    import pandas as pd
+    from visioncop.models import get_image_embedding
+    from visioncop.database import add_image
+
     try:
         original_dir = os.getcwd()
         os.chdir('visioncop')
@@ -175,25 +240,216 @@ def load_corel10k():
     print("Use: python run.py --load-corel10k\n")
     # ... (keep existing function for backward compatibility)
 
+def run_dedup():
+    """Cluster near-duplicate images across the whole index"""
+    print("🧬 Near-Duplicate Clustering")
+    print("Use: python run.py --dedup\n")
+
+    from visioncop.database import init_database
+    from visioncop.dedup import cluster_duplicates
+
+    init_database()
+    clusters = cluster_duplicates()
+
+    duplicates = sum(len(members) for members in clusters)
+    print(f"✅ Found {len(clusters)} duplicate clusters covering {duplicates} images")
+
+def _fit(matrix, dim, method, whiten):
+    """Fit a projection of the requested kind"""
+    from visioncop.reduction import fit_pca, fit_random_projection
+
+    if method == 'random':
+        return fit_random_projection(matrix.shape[1], dim)
+    return fit_pca(matrix, dim, whiten=whiten)
+
+def _print_evaluation(report):
+    """Print a projection evaluation report"""
+    print(f"📐 {report['method']} {report['dim']}-d ({report['compression']:.0f}x smaller): "
+          f"top-{report['k']} overlap {report['overlap'] * 100:.1f}%, "
+          f"with full-dim re-rank {report['reranked_overlap'] * 100:.1f}% "
+          f"({report['queries']} queries)")
+
+def fit_projection(dim, method, whiten):
+    """Fit, evaluate and install a dimensionality-reduction projection"""
+    print("📐 Embedding Dimensionality Reduction")
+    print("Use: python run.py --fit-projection 256 [--projection-method pca|random] [--whiten]\n")
+
+    from visioncop.database import init_database, get_embedding_matrix, bump_index_generation
+    from visioncop.reduction import evaluate_projection, save_projection
+
+    init_database()
+    filenames, matrix = get_embedding_matrix()
+    if len(filenames) < 2:
+        print("❌ Index at least a few images before fitting a projection")
+        return
+
+    projection = _fit(matrix, dim, method, whiten)
+    _print_evaluation(evaluate_projection(projection, matrix))
+
+    save_projection(projection)
+    bump_index_generation()
+    print("✅ Projection saved; servers pick it up on their next search")
+
+def evaluate_projections(dims, method, whiten):
+    """Report top-k overlap against full-dimensional search for several sizes"""
+    print("📐 Projection Evaluation")
+    print("Use: python run.py --evaluate-projection 128 256 512\n")
+
+    from visioncop.database import init_database, get_embedding_matrix
+    from visioncop.reduction import evaluate_projection
+
+    init_database()
+    filenames, matrix = get_embedding_matrix()
+    if len(filenames) < 2:
+        print("❌ Index at least a few images before evaluating projections")
+        return
+
+    for dim in dims:
+        _print_evaluation(evaluate_projection(_fit(matrix, dim, method, whiten), matrix))
+
+def run_benchmark(image_dir, random_weights=False):
+    """Benchmark the image preprocessing and bulk embedding paths"""
+    print("⏱️ Preprocessing Benchmark")
+    print("Use: python run.py --benchmark [IMAGE_DIR] [--random-weights]  (synthetic 12MP JPEGs if omitted)\n")
+
+    if random_weights:
+        # Must be set before visioncop.models is imported
+        os.environ["VISIONCOP_RANDOM_WEIGHTS"] = "1"
+
+    from visioncop.benchmark import benchmark_preprocessing, benchmark_embeddings
+
+    benchmark_preprocessing(image_dir or None)
+
+    print("\n🧮 Embedding Memory Benchmark")
+    benchmark_embeddings(image_dir or None)
+
+def export_index_snapshot(path):
+    """Write the current index to a portable snapshot file"""
+    print("📦 Index Snapshot Export")
+    print("Use: python run.py --export-snapshot PATH\n")
+
+    from visioncop.database import init_database
+    from visioncop.snapshot import export_snapshot
+
+    init_database()
+    info = export_snapshot(path)
+
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    print(f"✅ Exported {info['count']} images ({info['dim']}-d, {len(info['sections'])} sections, "
+          f"{size_mb:.1f} MB) to {path}")
+
+def import_index_snapshot(path, verify=True):
+    """Replace the local index with a snapshot file"""
+    print("📦 Index Snapshot Import")
+    print("Use: python run.py --import-snapshot PATH [--skip-verify]\n")
+
+    from visioncop.database import init_database
+    from visioncop.snapshot import import_snapshot
+
+    if not os.path.exists(path):
+        print(f"❌ {path} not found")
+        return
+
+    init_database()
+    try:
+        count = import_snapshot(path, verify=verify)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+
+    print(f"✅ Imported {count} images; servers map the new index on their next search")
+    print("🖼️ Copy the image files into visioncop/data/images separately")
+
+def run_load_test(base_url, concurrency, duration, mix, seed_images, server_pid, random_weights):
+    """Drive the FastAPI service with a synthetic request mix"""
+    print("🔥 API Load Test")
+    print("Use: python run.py --load-test [URL] [--concurrency N] [--duration S] [--mix search=6,image=3,upload=1]\n")
+
+    if random_weights:
+        # Must be set before visioncop.models is imported
+        os.environ["VISIONCOP_RANDOM_WEIGHTS"] = "1"
+
+    from visioncop.loadtest import load_test, parse_mix
+
+    try:
+        mix = parse_mix(mix) if mix else None
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+
+    load_test(base_url or None, concurrency, duration, mix, seed_images, server_pid)
+
+def run_profile_startup():
+    """Report cold import time of each VisionCOP subsystem"""
+    print("⏱️ Startup Import Profile")
+    print("Use: python run.py --profile-startup\n")
+
+    from visioncop.startup import profile_startup
+
+    profile_startup()
+
 def main():
     parser = argparse.ArgumentParser(description="VisionCOP AI Image Search")
     parser.add_argument('--serve', action='store_true', help='Start web server')
+    parser.add_argument('--serve-api', action='store_true', help='Start the FastAPI service with multiple workers')
+    parser.add_argument('--workers', type=int, help='Worker processes for --serve-api (default: half the CPUs)')
+    parser.add_argument('--port', type=int, default=8000, help='Port for --serve-api')
+    parser.add_argument('--fit-projection', type=int, metavar='DIM', help='Fit and install a reduced-dimension projection')
+    parser.add_argument('--evaluate-projection', type=int, nargs='+', metavar='DIM', help='Report top-k overlap of projections vs full-dimension search')
+    parser.add_argument('--projection-method', choices=['pca', 'random'], default='pca', help='Projection for --fit/--evaluate-projection')
+    parser.add_argument('--whiten', action='store_true', help='Whiten PCA components')
+    parser.add_argument('--index-workers', type=int, help='Run N background index workers (alongside --serve/--serve-api, default 1)')
     parser.add_argument('--load-mirflickr', action='store_true', help='Load MIRFLICKR dataset from zip file')
     parser.add_argument('--load-corel10k', action='store_true', help='Download Corel-10k dataset')
+    parser.add_argument('--dedup', action='store_true', help='Cluster near-duplicate images in the index')
+    parser.add_argument('--benchmark', nargs='?', const='', metavar='IMAGE_DIR', help='Benchmark image preprocessing')
+    parser.add_argument('--profile-startup', action='store_true', help='Report import time of each subsystem')
+    parser.add_argument('--export-snapshot', metavar='PATH', help='Export the index to a binary snapshot file')
+    parser.add_argument('--import-snapshot', metavar='PATH', help='Replace the index with a binary snapshot file')
+    parser.add_argument('--skip-verify', action='store_true', help='Skip snapshot checksum verification on --import-snapshot')
+    parser.add_argument('--load-test', nargs='?', const='', metavar='URL', help='Load-test the API (in-process if no URL)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients for --load-test')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run --load-test')
+    parser.add_argument('--mix', help='Request mix for --load-test, e.g. search=6,image=3,upload=1')
+    parser.add_argument('--seed-images', type=int, default=8, help='Images uploaded before --load-test starts timing')
+    parser.add_argument('--server-pid', type=int, help='Server process to sample CPU/RSS from during --load-test URL')
+    parser.add_argument('--random-weights', action='store_true', help='Use an untrained ResNet50 (no weight download)')
 
     # Default action is to serve if no args given
     if len(sys.argv) == 1:
-        start_server()
+        start_streamlit()
         return
 
     args = parser.parse_args()
+    index_workers = 1 if args.index_workers is None else args.index_workers
 
     if args.serve:
-        start_server()
+        start_streamlit(index_workers)
+    elif args.serve_api:
+        start_api_server(args.workers, args.port, index_workers)
     elif args.load_mirflickr:
         load_mirflickr()
     elif args.load_corel10k:
         load_corel10k()
+    elif args.dedup:
+        run_dedup()
+    elif args.benchmark is not None:
+        run_benchmark(args.benchmark, args.random_weights)
+    elif args.profile_startup:
+        run_profile_startup()
+    elif args.load_test is not None:
+        run_load_test(args.load_test, args.concurrency, args.duration, args.mix,
+                      args.seed_images, args.server_pid, args.random_weights)
+    elif args.export_snapshot:
+        export_index_snapshot(args.export_snapshot)
+    elif args.import_snapshot:
+        import_index_snapshot(args.import_snapshot, verify=not args.skip_verify)
+    elif args.fit_projection:
+        fit_projection(args.fit_projection, args.projection_method, args.whiten)
+    elif args.evaluate_projection:
+        evaluate_projections(args.evaluate_projection, args.projection_method, args.whiten)
+    elif args.index_workers:
+        run_index_workers(args.index_workers)
     else:
         parser.print_help()
 
@@ -1,16 +1,22 @@
-from fastapi import FastAPI, File, UploadFile, Request
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, File, Form, UploadFile, Request
+from fastapi.responses import HTMLResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
-import shutil
+from typing import List
 import os
-import uuid
-import sys
 
-# Add current directory to path for imports
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from visioncop.models import get_image_embedding, get_region_embeddings, load_resnet_model, REGION_EMBEDDINGS
+from visioncop.database import init_database, add_image, add_image_regions, get_all_images, find_duplicates, get_index_generation
+from visioncop.index import find_similar_images, find_similar_regions
+from visioncop.thumbnails import get_derivative, SIZES, FORMATS
+from visioncop.ingest import ingest_chunks, read_chunks, MAX_UPLOAD_BYTES
+from visioncop.jobs import enqueue_images, get_job, get_recent_jobs
+from visioncop.cache import exact_key, embedding_keys, get_cached, put_cached, get_cache_stats
+from visioncop.verification import extract_exif_record
 
-from models import get_image_embedding
-from database import init_database, add_image, find_similar_images, get_all_images
+# Multi-worker mode (python run.py --serve-api) imports this module once in the
+# master before forking, so the weights loaded here are shared copy-on-write
+if os.environ.get("VISIONCOP_PRELOAD_MODEL"):
+    load_resnet_model()
 
 app = FastAPI(title="VisionCOP", description="AI Image Similarity Search Engine")
 
@@ -31,23 +37,54 @@ async def read_root():
     index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "index.html")
     return FileResponse(index_path, media_type="text/html")
 
+def store_upload(file):
+    """Stream an upload into the images directory; raises ValueError if rejected."""
+    if file.size and file.size > MAX_UPLOAD_BYTES:
+        raise ValueError(f"file exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit")
+    upload = ingest_chunks(read_chunks(file.file), DATA_PATH)
+    upload['metadata'] = {
+        'source': 'upload',
+        'original_filename': file.filename,
+        'sha256': upload['sha256']
+    }
+    return upload
+
 @app.post("/upload")
-async def upload_image(file: UploadFile = File(...)):
-    """Upload and index an image."""
+async def upload_image(file: UploadFile = File(...), background: bool = True):
+    """Upload an image and queue it for indexing (or index inline with background=false)."""
     try:
-        # Save the uploaded file
-        file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(DATA_PATH, unique_filename)
+        # Stream the upload to disk, rejecting bad files early
+        upload = store_upload(file)
+        unique_filename = upload['filename']
+        file_path = upload['path']
+
+        if background:
+            job_id = enqueue_images([upload])
+            return {
+                "success": True,
+                "message": f"Image {file.filename} uploaded and queued for indexing",
+                "filename": unique_filename,
+                "job_id": job_id
+            }
 
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Keep the compared EXIF fields so verification needn't reopen the file
+        try:
+            upload['metadata']['exif'] = extract_exif_record(upload['data'])
+        except Exception as e:
+            print(f"Error reading EXIF for {unique_filename}: {e}")
+        upload['data'].seek(0)
 
-        # Get embedding
-        embedding = get_image_embedding(file_path)
+        # Get embedding from the buffered bytes (no second disk read)
+        if REGION_EMBEDDINGS:
+            regions = get_region_embeddings([upload['data']])[0]
+            embedding = regions[0] if regions is not None else None
+            if regions is not None:
+                add_image_regions(unique_filename, regions)
+        else:
+            embedding = get_image_embedding(upload['data'])
 
         # Store in database
-        success = add_image(unique_filename, embedding)
+        success = add_image(unique_filename, embedding, upload['metadata'])
 
         if success:
             return {
@@ -63,31 +100,113 @@ async def upload_image(file: UploadFile = File(...)):
                 "message": "Failed to index image"
             }
 
+    except ValueError as e:
+        return {
+            "success": False,
+            "message": f"Rejected {file.filename}: {str(e)}"
+        }
     except Exception as e:
         return {
             "success": False,
             "message": f"Error uploading image: {str(e)}"
         }
 
-@app.post("/search")
-async def search_similar(file: UploadFile = File(...)):
-    """Search for similar images."""
+@app.post("/jobs")
+async def create_index_job(files: List[UploadFile] = File(...)):
+    """Upload a batch of images and queue them as one indexing job."""
+    uploads = []
+    errors = []
+    for file in files:
+        try:
+            upload = store_upload(file)
+            # The worker reads from disk; don't hold every buffer for the batch
+            del upload['data']
+            uploads.append(upload)
+        except Exception as e:
+            errors.append(f"{file.filename}: {str(e)}")
+
+    if not uploads:
+        return {
+            "success": False,
+            "message": "No valid images to index",
+            "errors": errors
+        }
+
     try:
-        # Save temp file for processing
-        temp_filename = f"temp_{uuid.uuid4()}.jpg"
-        temp_path = os.path.join(DATA_PATH, temp_filename)
+        job_id = enqueue_images(uploads)
+    except Exception as e:
+        return {
+            "success": False,
+            "message": f"Error queueing images: {str(e)}"
+        }
+
+    return {
+        "success": True,
+        "message": f"Queued {len(uploads)} image(s) for indexing",
+        "job_id": job_id,
+        "errors": errors
+    }
 
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+@app.get("/jobs")
+async def list_index_jobs(limit: int = 20):
+    """List recent indexing jobs with their progress."""
+    return {"jobs": get_recent_jobs(limit)}
+
+@app.get("/jobs/{job_id}")
+async def get_index_job(job_id: int):
+    """Get progress and throughput of an indexing job."""
+    job = get_job(job_id)
+    if job is None:
+        return {"error": "Job not found"}
+    return job
+
+# A plain def: FastAPI runs it in its threadpool, so embedding the query and
+# mapping or rebuilding the index snapshot don't block the event loop
+@app.post("/search")
+def search_similar(
+    file: UploadFile = File(...),
+    source: str = Form(None),
+    labels: str = Form(None),
+    date_from: str = Form(None),
+    date_to: str = Form(None),
+    mode: str = Form("global")
+):
+    """
+    Search for similar images, optionally restricted by metadata filters.
+    mode="regions" matches crops of the query against stored image regions.
+    """
+    try:
+        # Validate the query in memory; it is never written to disk
+        query = ingest_chunks(read_chunks(file.file))
 
-        # Get embedding for search query
-        query_embedding = get_image_embedding(temp_path)
+        # Exact repeats of a recent query are answered without embedding it
+        top_k = 5
+        params = (mode, top_k, source, labels, date_from, date_to)
+        generation = get_index_generation()
+        cache_keys = [exact_key(query['sha256'], params)]
+        similar = get_cached(cache_keys, generation)
 
-        # Clean up temp file
-        os.remove(temp_path)
+        if similar is None:
+            # Get embedding for search query
+            filters = dict(source=source, labels=labels, date_from=date_from, date_to=date_to)
+            if mode == "regions":
+                query_embedding = get_region_embeddings([query['data']])[0]
+            else:
+                query_embedding = get_image_embedding(query['data'])
+            if query_embedding is None:
+                raise ValueError("could not compute query embedding")
 
-        # Find similar images
-        similar = find_similar_images(query_embedding, top_k=5)
+            # Near repeats land in (or next to) the same LSH bucket
+            near_keys = embedding_keys(query_embedding, params)
+            similar = get_cached(near_keys, generation, query_embedding)
+            if similar is None:
+                if mode == "regions":
+                    similar = find_similar_regions(query_embedding, top_k=top_k, **filters)
+                else:
+                    similar = find_similar_images(query_embedding, top_k=top_k, **filters)
+                if similar is None:
+                    raise RuntimeError("index search failed")
+            put_cached(cache_keys + near_keys[:1], generation, similar, query_embedding)
 
         return {
             "success": True,
@@ -101,15 +220,40 @@ async def search_similar(file: UploadFile = File(...)):
             "message": f"Error searching images: {str(e)}"
         }
 
+IMAGE_CACHE_CONTROL = "public, max-age=86400"
+
 @app.get("/images/{filename}")
-async def get_image(filename: str):
-    """Serve uploaded images."""
+async def get_image(filename: str, request: Request, size: str = None, format: str = "webp"):
+    """Serve uploaded images, or a cached resized derivative when size is given."""
     file_path = os.path.join(DATA_PATH, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    else:
+    if not os.path.exists(file_path):
         return {"error": "Image not found"}
 
+    if size is None:
+        return FileResponse(file_path, headers={"Cache-Control": IMAGE_CACHE_CONTROL})
+
+    if size not in SIZES or format not in FORMATS:
+        return {"error": f"Unsupported size or format (sizes: {list(SIZES)}, formats: {list(FORMATS)})"}
+
+    derivative_path, key = get_derivative(file_path, size, format)
+    if derivative_path is None:
+        return {"error": "Could not create image derivative"}
+
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(derivative_path, media_type=FORMATS[format][1], headers=headers)
+
+@app.get("/duplicates/{filename}")
+async def get_duplicates(filename: str):
+    """List near-duplicates of an indexed image found by the dedup job."""
+    return {
+        "filename": filename,
+        "duplicates": find_duplicates(filename)
+    }
+
 @app.get("/status")
 async def get_status():
     """Get system status and statistics."""
@@ -118,7 +262,8 @@ async def get_status():
         return {
             "status": "running",
             "total_images": total_images,
-            "model": "ResNet50"
+            "model": "ResNet50",
+            "search_cache": get_cache_stats()
         }
     except Exception as e:
         return {"status": "error", "message": str(e)}
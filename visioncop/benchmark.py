@@ -0,0 +1,138 @@
+"""
+Micro-benchmarks for the embedding pipeline.
+
+Compares the reference torchvision preprocessing (full decode + Resize +
+ToTensor + Normalize) against the fast path in models.py (JPEG draft
+decode + in-place uint8 normalization) on real or synthetic images, and
+tracks RSS and garbage collections across repeated bulk embedding runs.
+"""
+
+import os
+import io
+import gc
+import time
+import resource
+import numpy as np
+from PIL import Image, ImageFilter
+
+from visioncop.models import (
+    build_reference_transform, load_image, preprocess_image,
+    load_resnet_model, get_image_embeddings, EMBEDDING_DIM
+)
+
+def make_synthetic_jpegs(count=8, size=(4000, 3000), seed=0):
+    """Create smooth multi-megapixel JPEGs in memory (camera-photo stand-ins)."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        small = rng.integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+def _load_sources(image_dir):
+    """Read benchmark inputs as raw bytes, so disk I/O is not timed."""
+    if not image_dir:
+        return make_synthetic_jpegs()
+    sources = []
+    for file in sorted(os.listdir(image_dir)):
+        if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+            with open(os.path.join(image_dir, file), 'rb') as f:
+                sources.append(f.read())
+    return sources
+
+def _time_per_image(fn, sources, repeats):
+    """Best-of-repeats mean seconds per image for fn(bytes)."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for data in sources:
+            fn(data)
+        best = min(best, (time.perf_counter() - start) / len(sources))
+    return best
+
+def benchmark_preprocessing(image_dir=None, repeats=3):
+    """Time reference vs fast preprocessing and report their numerical difference."""
+    sources = _load_sources(image_dir)
+    if not sources:
+        print("❌ No images to benchmark")
+        return {}
+
+    reference = build_reference_transform()
+
+    def run_reference(data):
+        return reference(Image.open(io.BytesIO(data)).convert('RGB'))
+
+    def run_fast(data):
+        return preprocess_image(load_image(io.BytesIO(data)))
+
+    rss_start = _rss_mb()
+    reference_time = _time_per_image(run_reference, sources, repeats)
+    rss_reference = _rss_mb()
+    fast_time = _time_per_image(run_fast, sources, repeats)
+    rss_fast = _rss_mb()
+
+    diffs = [(run_reference(data) - run_fast(data)).abs() for data in sources]
+    results = {
+        'images': len(sources),
+        'reference_ms': reference_time * 1000,
+        'fast_ms': fast_time * 1000,
+        'speedup': reference_time / fast_time,
+        'max_abs_diff': max(float(d.max()) for d in diffs),
+        'mean_abs_diff': float(np.mean([float(d.mean()) for d in diffs])),
+        'reference_rss_growth_mb': rss_reference - rss_start,
+        'fast_rss_growth_mb': rss_fast - rss_reference,
+    }
+
+    print(f"🖼️ Images: {results['images']}")
+    print(f"🐢 Reference preprocessing: {results['reference_ms']:.1f} ms/image")
+    print(f"⚡ Fast preprocessing: {results['fast_ms']:.1f} ms/image ({results['speedup']:.1f}x)")
+    print(f"📏 Normalized tensor diff: max {results['max_abs_diff']:.3f}, mean {results['mean_abs_diff']:.4f}")
+    print(f"💾 RSS growth: reference {results['reference_rss_growth_mb']:+.1f} MB, "
+          f"fast {results['fast_rss_growth_mb']:+.1f} MB")
+    return results
+
+def _rss_mb():
+    """Current resident set size of this process in MB (Linux /proc)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        # Elsewhere fall back to the peak, which still shows growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def benchmark_embeddings(image_dir=None, rounds=5, batch_size=16):
+    """
+    Run repeated bulk embedding passes and report time, RSS and garbage
+    collections per round. With reused buffers RSS should stay flat after
+    the first round (which loads the model and sizes the buffers).
+    """
+    sources = _load_sources(image_dir)
+    if not sources:
+        print("❌ No images to benchmark")
+        return []
+
+    load_resnet_model()
+    out = np.empty((len(sources), EMBEDDING_DIM), dtype=np.float32)
+
+    results = []
+    for round_number in range(1, rounds + 1):
+        collections = sum(stat['collections'] for stat in gc.get_stats())
+        start = time.perf_counter()
+        get_image_embeddings([io.BytesIO(data) for data in sources], batch_size=batch_size, out=out)
+        elapsed = time.perf_counter() - start
+
+        results.append({
+            'round': round_number,
+            'ms_per_image': elapsed * 1000 / len(sources),
+            'rss_mb': _rss_mb(),
+            'gc_collections': sum(stat['collections'] for stat in gc.get_stats()) - collections,
+        })
+        print(f"🧮 Round {round_number}: {results[-1]['ms_per_image']:.1f} ms/image, "
+              f"RSS {results[-1]['rss_mb']:.1f} MB, {results[-1]['gc_collections']} GC collections")
+
+    growth = results[-1]['rss_mb'] - results[0]['rss_mb']
+    print(f"📈 RSS growth after round 1: {growth:+.1f} MB over {rounds - 1} rounds")
+    return results
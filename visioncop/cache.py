@@ -0,0 +1,127 @@
+"""
+Per-process cache of search results.
+
+Results are stored under two keys: the SHA-256 of the query bytes (exact
+repeats skip decoding and the embedding entirely) and a locality-sensitive
+hash of the query embedding, the signs of LSH_BITS random projections.
+A near repeat (e.g. a re-encoded copy) is looked up in its own bucket and
+in the LSH_PROBES buckets one least-certain bit away, and is only served
+an entry whose stored query has cosine similarity of at least
+NEAR_REPEAT_SIMILARITY, so bucket collisions never return another
+image's results. Every entry is tagged with the index generation it was
+computed at, so anything cached before an add_image is never served.
+Entries expire after SEARCH_CACHE_TTL seconds and the least recently used
+are evicted beyond SEARCH_CACHE_SIZE. Hit rates are kept per key kind.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 300
+
+# Random projections whose signs form the near-repeat key, from a fixed seed
+# so every worker (and every restart) hashes the same way
+LSH_BITS = 32
+LSH_SEED = 0
+
+# Extra buckets probed, each with one of the least certain bits flipped
+LSH_PROBES = 4
+
+# Minimum cosine similarity between a query and a cached query it may reuse
+NEAR_REPEAT_SIMILARITY = 0.98
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {'exact': {'hits': 0, 'misses': 0}, 'embedding': {'hits': 0, 'misses': 0}}
+_hyperplanes = {}
+
+def exact_key(sha256, params):
+    """Cache key for an exact repeat of the query bytes."""
+    return ('exact', sha256, params)
+
+def _get_hyperplanes(dim):
+    """(dim, LSH_BITS) projection directions for embeddings of a dimension."""
+    if dim not in _hyperplanes:
+        planes = np.random.default_rng(LSH_SEED).standard_normal((dim, LSH_BITS)).astype(np.float32)
+        # Zero-sum directions ignore the offset all (non-negative) ResNet features share
+        _hyperplanes[dim] = planes - planes.mean(axis=0)
+    return _hyperplanes[dim]
+
+def embedding_keys(embedding, params):
+    """
+    Cache keys for a near repeat of the query embedding (one vector, or one
+    per region): its LSH bucket first, then the LSH_PROBES buckets with one
+    of its least certain bits flipped. Results are stored under the first.
+    """
+    vectors = np.atleast_2d(np.asarray(embedding, dtype=np.float32))
+    margins = (vectors @ _get_hyperplanes(vectors.shape[1])).ravel()
+    bits = margins > 0
+
+    keys = [('embedding', np.packbits(bits).tobytes().hex(), params)]
+    for bit in np.argsort(np.abs(margins))[:LSH_PROBES]:
+        probe = bits.copy()
+        probe[bit] = not probe[bit]
+        keys.append(('embedding', np.packbits(probe).tobytes().hex(), params))
+    return keys
+
+def _similar_query(embedding, cached):
+    """Whether a query embedding is a near repeat of a cached one (per region, if any)."""
+    if cached is None or np.shape(cached) != np.shape(embedding):
+        return False
+    cached = np.atleast_2d(cached)
+    vectors = np.atleast_2d(np.asarray(embedding, dtype=np.float32))
+    return bool(np.einsum('ij,ij->i', vectors, cached).min() >= NEAR_REPEAT_SIMILARITY)
+
+def get_cached(keys, generation, embedding=None):
+    """
+    Get the cached results of the first live entry among keys at this index
+    generation, or None. With embedding, an entry is only served to a near
+    repeat of the query it was stored for.
+    """
+    now = time.monotonic()
+    with _lock:
+        stats = _stats[keys[0][0]]
+        for key in keys:
+            entry = _cache.get(key)
+            if entry is None:
+                continue
+            if entry[0] != generation or entry[1] < now:
+                del _cache[key]
+                continue
+            if embedding is not None and not _similar_query(embedding, entry[3]):
+                continue
+
+            _cache.move_to_end(key)
+            stats['hits'] += 1
+            return entry[2]
+
+        stats['misses'] += 1
+        return None
+
+def put_cached(keys, generation, results, embedding=None):
+    """Store results under each of the given keys, with the query embedding they were computed for."""
+    expires = time.monotonic() + SEARCH_CACHE_TTL
+    if embedding is not None:
+        embedding = np.array(embedding, dtype=np.float32)
+    with _lock:
+        for key in keys:
+            _cache[key] = (generation, expires, results, embedding)
+            _cache.move_to_end(key)
+        while len(_cache) > SEARCH_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def get_cache_stats():
+    """Current size, plus hit/miss counters and hit rate overall and per key kind."""
+    def with_rate(hits, misses):
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+    with _lock:
+        report = with_rate(sum(stats['hits'] for stats in _stats.values()),
+                           sum(stats['misses'] for stats in _stats.values()))
+        report['entries'] = len(_cache)
+        for kind, stats in _stats.items():
+            report[kind] = with_rate(stats['hits'], stats['misses'])
+        return report
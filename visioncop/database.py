@@ -2,7 +2,7 @@ import sqlite3
 import os
 import json
 import numpy as np
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
 DB_PATH = 'visioncop.db'
 DATA_PATH = 'visioncop/data/images'
@@ -15,6 +15,9 @@ def init_database():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
+    # WAL lets server workers and index workers read while another process writes
+    cursor.execute('PRAGMA journal_mode=WAL')
+
     # Create initial table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS images (
@@ -33,9 +36,158 @@ def init_database():
         # Column already exists
         pass
 
+    # Inverted index of metadata labels, keyed by filename so that
+    # INSERT OR REPLACE on images does not orphan rows
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_labels (
+            label TEXT,
+            filename TEXT,
+            PRIMARY KEY (label, filename)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_image_labels_filename ON image_labels(filename)')
+
+    # Promote metadata source into an indexed column (migration)
+    try:
+        cursor.execute("ALTER TABLE images ADD COLUMN source TEXT")
+        _backfill_metadata_index(cursor)
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+
+    # Perceptual hash and near-duplicate cluster written by the dedup job (migration)
+    for column in ('phash TEXT', 'cluster_id INTEGER'):
+        try:
+            cursor.execute(f"ALTER TABLE images ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            # Column already exists
+            pass
+
+    # Index generation, bumped on every write so server workers know when
+    # their in-memory embedding index is stale
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS index_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO index_state (key, value) VALUES ('generation', 0)")
+    # Bumped only by changes other than appending images (deletes, a new
+    # projection), which need the index snapshot rebuilt rather than extended
+    cursor.execute("INSERT OR IGNORE INTO index_state (key, value) VALUES ('layout', 0)")
+
+    # Multi-region embeddings, one float16 (regions x dim) BLOB per image
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_regions (
+            filename TEXT PRIMARY KEY,
+            region_count INTEGER,
+            embeddings BLOB
+        )
+    ''')
+
+    # Background indexing queue (see jobs.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS index_jobs (
+            id INTEGER PRIMARY KEY,
+            status TEXT,
+            total INTEGER,
+            completed INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS index_job_items (
+            id INTEGER PRIMARY KEY,
+            job_id INTEGER,
+            filename TEXT,
+            path TEXT,
+            metadata TEXT,
+            status TEXT,
+            worker_pid INTEGER,
+            error TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_job_items_status ON index_job_items(status, id)')
+
+    # Claims per item, so an image that keeps killing workers is eventually failed (migration)
+    try:
+        cursor.execute("ALTER TABLE index_job_items ADD COLUMN attempts INTEGER DEFAULT 0")
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_images_source ON images(source)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_images_cluster ON images(cluster_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_images_upload_date ON images(upload_date)')
+
     conn.commit()
     conn.close()
 
+def _extract_labels(metadata):
+    """Normalize the labels stored in metadata into a sorted list of tags."""
+    labels = (metadata or {}).get('labels')
+    if not labels:
+        return []
+    if isinstance(labels, str):
+        labels = labels.replace(',', ' ').split()
+    return sorted({str(label).strip().lower() for label in labels if str(label).strip()})
+
+def _index_metadata(cursor, filename, metadata):
+    """Write the label index rows for an image, replacing any previous ones."""
+    cursor.execute('DELETE FROM image_labels WHERE filename = ?', (filename,))
+    cursor.executemany(
+        'INSERT OR IGNORE INTO image_labels (label, filename) VALUES (?, ?)',
+        [(label, filename) for label in _extract_labels(metadata)]
+    )
+
+def _backfill_metadata_index(cursor):
+    """Populate source and label index for rows stored before the migration."""
+    cursor.execute('SELECT filename, metadata FROM images WHERE metadata IS NOT NULL')
+    for filename, metadata_json in cursor.fetchall():
+        try:
+            metadata = json.loads(metadata_json)
+        except ValueError:
+            continue
+        cursor.execute('UPDATE images SET source = ? WHERE filename = ?', (metadata.get('source'), filename))
+        _index_metadata(cursor, filename, metadata)
+
+def _day_after(value):
+    """ISO date of the following day if value is a bare YYYY-MM-DD date, else None."""
+    try:
+        return (date.fromisoformat(value) + timedelta(days=1)).isoformat() if len(value) == 10 else None
+    except ValueError:
+        return None
+
+def _build_filter(source=None, labels=None, date_from=None, date_to=None):
+    """Build a SQL WHERE fragment and parameters from metadata predicates."""
+    clauses = []
+    params = []
+
+    if source:
+        clauses.append('source = ?')
+        params.append(source)
+    if date_from:
+        clauses.append('upload_date >= ?')
+        params.append(date_from)
+    if date_to:
+        day_after = _day_after(date_to)
+        if day_after:
+            # A bare date includes uploads made during that day
+            clauses.append('upload_date < ?')
+            params.append(day_after)
+        else:
+            clauses.append('upload_date <= ?')
+            params.append(date_to)
+    # Every requested label must be present
+    for label in _extract_labels({'labels': labels}):
+        clauses.append('filename IN (SELECT filename FROM image_labels WHERE label = ?)')
+        params.append(label)
+
+    return ''.join(f' AND {clause}' for clause in clauses), params
+
 def add_image(filename, embedding, metadata=None):
     """Add an image and its embedding to the database."""
     try:
@@ -48,10 +200,14 @@ def add_image(filename, embedding, metadata=None):
         # Convert metadata to JSON string
         metadata_json = json.dumps(metadata) if metadata else None
 
+        source = metadata.get('source') if metadata else None
+
         cursor.execute('''
-            INSERT OR REPLACE INTO images (filename, path, embedding, upload_date, metadata)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (filename, f'{DATA_PATH}/{filename}', embedding_bytes, datetime.now().isoformat(), metadata_json))
+            INSERT OR REPLACE INTO images (filename, path, embedding, upload_date, metadata, source)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (filename, f'{DATA_PATH}/{filename}', embedding_bytes, datetime.now().isoformat(), metadata_json, source))
+        _index_metadata(cursor, filename, metadata)
+        cursor.execute("UPDATE index_state SET value = value + 1 WHERE key = 'generation'")
 
         conn.commit()
         conn.close()
@@ -75,35 +231,414 @@ def get_all_images():
         print(f"Error getting images: {e}")
         return []
 
-def find_similar_images(query_embedding, top_k=5):
-    """Find similar images using cosine similarity."""
-    if query_embedding is None:
-        return []
+def add_image_regions(filename, region_embeddings):
+    """Store an image's region embeddings (regions x dim) in compact float16."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        regions = np.asarray(region_embeddings, dtype=np.float16)
+        cursor.execute('INSERT OR REPLACE INTO image_regions (filename, region_count, embeddings) VALUES (?, ?, ?)',
+                       (filename, regions.shape[0], regions.tobytes()))
+        cursor.execute("UPDATE index_state SET value = value + 1 WHERE key = 'generation'")
+
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Error adding image regions: {e}")
+        return False
 
+def get_region_matrix(after_id=0):
+    """
+    Load region embeddings as (filenames, region counts, float16 matrix),
+    optionally only for images with ids above after_id.
+    """
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
 
-        # Get all embeddings
-        cursor.execute('SELECT filename, embedding FROM images WHERE embedding IS NOT NULL')
+        cursor.execute('''
+            SELECT r.filename, r.region_count, r.embeddings FROM image_regions AS r
+            JOIN images AS img ON img.filename = r.filename
+            WHERE img.id > ?
+            ORDER BY img.id
+        ''', (after_id,))
         rows = cursor.fetchall()
+        conn.close()
+
+        if not rows:
+            return [], [], np.zeros((0, 0), dtype=np.float16)
+
+        total = sum(row[1] for row in rows)
+        matrix = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.float16).reshape(total, -1)
+        return [row[0] for row in rows], [row[1] for row in rows], matrix
+    except Exception as e:
+        print(f"Error loading region embeddings: {e}")
+        return [], [], np.zeros((0, 0), dtype=np.float16)
+
+def get_region_blocks(until_id, block_rows=1024):
+    """
+    Read the region embeddings of embedded images with ids up to until_id,
+    in id order, without holding them all at once. Returns (count, dim,
+    blocks), where count is the total number of regions and blocks yields
+    (filenames, region counts, float16 matrix) for at most block_rows images.
+    """
+    try:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        cursor = conn.cursor()
+
+        cursor.execute('BEGIN')
+        cursor.execute('''
+            SELECT SUM(r.region_count), MAX(LENGTH(r.embeddings) / (2 * r.region_count)) FROM image_regions AS r
+            JOIN images AS img ON img.filename = r.filename
+            WHERE img.id <= ? AND img.embedding IS NOT NULL AND r.region_count > 0
+        ''', (until_id,))
+        count, dim = cursor.fetchone()
+    except Exception as e:
+        print(f"Error loading region embeddings: {e}")
+        return 0, 0, iter(())
+
+    def blocks():
+        try:
+            last_id = 0
+            while True:
+                cursor.execute('''
+                    SELECT img.id, r.filename, r.region_count, r.embeddings FROM image_regions AS r
+                    JOIN images AS img ON img.filename = r.filename
+                    WHERE img.id > ? AND img.id <= ? AND img.embedding IS NOT NULL AND r.region_count > 0
+                    ORDER BY img.id LIMIT ?
+                ''', (last_id, until_id, block_rows))
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                last_id = rows[-1][0]
+                total = sum(row[2] for row in rows)
+                matrix = np.frombuffer(b''.join(row[3] for row in rows), dtype=np.float16).reshape(total, -1)
+                yield [row[1] for row in rows], [row[2] for row in rows], matrix
+        finally:
+            conn.close()
+
+    return count or 0, dim or 0, blocks()
+
+def bump_index_generation():
+    """Mark server indexes for a full rebuild (e.g. after the projection changes)."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute("UPDATE index_state SET value = value + 1 WHERE key IN ('generation', 'layout')")
+
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Error bumping index generation: {e}")
+        return False
+
+def get_index_generation():
+    """Get the current index generation (changes whenever images are added)."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT value FROM index_state WHERE key = 'generation'")
+        row = cursor.fetchone()
+
+        conn.close()
+        return row[0] if row else 0
+    except Exception as e:
+        print(f"Error getting index generation: {e}")
+        return 0
+
+def get_index_state():
+    """Get the current (generation, layout) pair; see init_database."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
 
-        similarities = []
-        for filename, embedding_bytes in rows:
-            if embedding_bytes:
-                # Convert bytes back to numpy array
-                db_embedding = np.frombuffer(embedding_bytes, dtype=np.float32)
+        cursor.execute("SELECT key, value FROM index_state WHERE key IN ('generation', 'layout')")
+        state = dict(cursor.fetchall())
 
-                # Calculate cosine similarity
-                similarity = np.dot(query_embedding, db_embedding)
-                similarities.append((filename, similarity))
+        conn.close()
+        return state.get('generation', 0), state.get('layout', 0)
+    except Exception as e:
+        print(f"Error getting index state: {e}")
+        return 0, 0
+
+def get_filtered_ids(source=None, labels=None, date_from=None, date_to=None):
+    """Get the sorted ids of embedded images matching the metadata filters (no BLOB reads)."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        where, params = _build_filter(source, labels, date_from, date_to)
+        cursor.execute('SELECT id FROM images WHERE embedding IS NOT NULL' + where + ' ORDER BY id', params)
+        ids = np.fromiter((row[0] for row in cursor), dtype=np.int64)
 
-        # Sort by similarity and return top_k
-        similarities.sort(key=lambda x: x[1], reverse=True)
         conn.close()
+        return ids
+    except Exception as e:
+        print(f"Error filtering images: {e}")
+        return np.zeros(0, dtype=np.int64)
+
+def get_embeddings_by_filename(filenames):
+    """Get stored embeddings for the given filenames as {filename: array}."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
 
-        return [{'filename': fname, 'similarity': sim} for fname, sim in similarities[:top_k]]
+        placeholders = ','.join('?' * len(filenames))
+        cursor.execute(f'SELECT filename, embedding FROM images WHERE embedding IS NOT NULL AND filename IN ({placeholders})',
+                       list(filenames))
+        rows = cursor.fetchall()
 
+        conn.close()
+        return {row[0]: np.frombuffer(row[1], dtype=np.float32) for row in rows}
+    except Exception as e:
+        print(f"Error getting embeddings: {e}")
+        return {}
+
+def get_embedding_matrix():
+    """Load all stored embeddings as (filenames, float32 matrix)."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT filename, embedding FROM images WHERE embedding IS NOT NULL ORDER BY id')
+        rows = cursor.fetchall()
+        conn.close()
+
+        if not rows:
+            return [], np.zeros((0, 0), dtype=np.float32)
+
+        filenames = [row[0] for row in rows]
+        matrix = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        return filenames, matrix
+    except Exception as e:
+        print(f"Error loading embeddings: {e}")
+        return [], np.zeros((0, 0), dtype=np.float32)
+
+def get_embedding_rows(after_id=0):
+    """
+    Load the embeddings of images with ids above after_id, in id order, as
+    (int64 ids, filenames, float32 matrix).
+    """
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT id, filename, embedding FROM images WHERE id > ? AND embedding IS NOT NULL ORDER BY id',
+                       (after_id,))
+        rows = cursor.fetchall()
+        conn.close()
+
+        if not rows:
+            return np.zeros(0, dtype=np.int64), [], np.zeros((0, 0), dtype=np.float32)
+
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        filenames = [row[1] for row in rows]
+        matrix = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        return ids, filenames, matrix
+    except Exception as e:
+        print(f"Error loading embeddings: {e}")
+        return np.zeros(0, dtype=np.int64), [], np.zeros((0, 0), dtype=np.float32)
+
+def get_embedding_blocks(block_rows=4096):
+    """
+    Read every stored embedding in id order without holding them all at once.
+    Returns (count, dim, blocks), where blocks yields (int64 ids, filenames,
+    float32 matrix) of at most block_rows rows. The count and every block
+    come from one read transaction, so they agree even while others write.
+    """
+    try:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        cursor = conn.cursor()
+
+        cursor.execute('BEGIN')
+        cursor.execute('SELECT COUNT(*), MAX(LENGTH(embedding)) FROM images WHERE embedding IS NOT NULL')
+        count, size = cursor.fetchone()
+    except Exception as e:
+        print(f"Error loading embeddings: {e}")
+        return 0, 0, iter(())
+
+    def blocks():
+        try:
+            last_id = 0
+            while True:
+                cursor.execute('SELECT id, filename, embedding FROM images WHERE id > ? AND embedding IS NOT NULL '
+                               'ORDER BY id LIMIT ?', (last_id, block_rows))
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                last_id = rows[-1][0]
+                ids = np.array([row[0] for row in rows], dtype=np.int64)
+                matrix = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+                yield ids, [row[1] for row in rows], matrix
+        finally:
+            conn.close()
+
+    return count, (size or 0) // 4, blocks()
+
+def get_image_records():
+    """Get the stored columns of every embedded image as {filename: record} (no BLOB reads)."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT filename, path, upload_date, source, phash, cluster_id, metadata
+            FROM images WHERE embedding IS NOT NULL
+        ''')
+        rows = cursor.fetchall()
+
+        conn.close()
+        return {row[0]: {'filename': row[0], 'path': row[1], 'upload_date': row[2], 'source': row[3],
+                         'phash': row[4], 'cluster_id': row[5], 'metadata': row[6]} for row in rows}
+    except Exception as e:
+        print(f"Error getting image records: {e}")
+        return {}
+
+def replace_images(records, matrix, region_counts=None, regions=None):
+    """
+    Replace every stored image with the given records (as returned by
+    get_image_records) and their embedding rows, in one transaction.
+    Optional region_counts and float16 regions hold each record's regions
+    contiguously, in order. Returns the new index state as a dict with
+    'generation', 'layout' and 'last_id' (the id of the last record), or
+    None on failure.
+    """
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute('DELETE FROM images')
+        cursor.execute('DELETE FROM image_labels')
+        cursor.execute('DELETE FROM image_regions')
+
+        # Inserted in order, so ids (and get_embedding_matrix) follow the records
+        cursor.executemany('''
+            INSERT INTO images (filename, path, embedding, upload_date, metadata, source, phash, cluster_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', ((record['filename'], record['path'], np.asarray(matrix[i], dtype=np.float32).tobytes(),
+               record['upload_date'], record['metadata'], record['source'], record['phash'], record['cluster_id'])
+              for i, record in enumerate(records)))
+
+        cursor.executemany(
+            'INSERT OR IGNORE INTO image_labels (label, filename) VALUES (?, ?)',
+            ((label, record['filename'])
+             for record in records if record['metadata']
+             for label in _extract_labels(json.loads(record['metadata'])))
+        )
+
+        if region_counts is not None:
+            ends = np.cumsum(region_counts)
+            cursor.executemany(
+                'INSERT INTO image_regions (filename, region_count, embeddings) VALUES (?, ?, ?)',
+                ((record['filename'], int(count), np.asarray(regions[end - count:end], dtype=np.float16).tobytes())
+                 for record, count, end in zip(records, region_counts, ends) if count)
+            )
+
+        cursor.execute("UPDATE index_state SET value = value + 1 WHERE key IN ('generation', 'layout')")
+        cursor.execute("SELECT key, value FROM index_state WHERE key IN ('generation', 'layout')")
+        state = dict(cursor.fetchall())
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM images')
+        state['last_id'] = cursor.fetchone()[0]
+
+        conn.commit()
+        conn.close()
+        return state
+    except Exception as e:
+        print(f"Error replacing images: {e}")
+        return None
+
+def get_image_hashes():
+    """Get a mapping of filename to its stored path and pHash hex string (None if missing)."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT filename, path, phash FROM images')
+        rows = cursor.fetchall()
+
+        conn.close()
+        return {row[0]: {'path': row[1], 'phash': row[2]} for row in rows}
+    except Exception as e:
+        print(f"Error getting image hashes: {e}")
+        return {}
+
+def get_exif_records():
+    """Get the EXIF records stored at index time as {filename: record}."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT filename, metadata FROM images WHERE metadata LIKE '%\"exif\"%'")
+        rows = cursor.fetchall()
+
+        conn.close()
+        records = {}
+        for filename, metadata_json in rows:
+            exif = json.loads(metadata_json).get('exif')
+            if exif is not None:
+                records[filename] = exif
+        return records
+    except Exception as e:
+        print(f"Error getting EXIF records: {e}")
+        return {}
+
+def set_image_hashes(hashes):
+    """Store pHash hex strings for the given {filename: phash} mapping."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.executemany('UPDATE images SET phash = ? WHERE filename = ?',
+                           [(phash, filename) for filename, phash in hashes.items()])
+
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Error storing image hashes: {e}")
+        return False
+
+def save_duplicate_clusters(clusters):
+    """Replace all duplicate clusters with the given list of filename groups."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute('UPDATE images SET cluster_id = NULL')
+        cursor.executemany('UPDATE images SET cluster_id = ? WHERE filename = ?',
+                           [(cluster_id, filename)
+                            for cluster_id, members in enumerate(clusters, start=1)
+                            for filename in members])
+
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Error saving duplicate clusters: {e}")
+        return False
+
+def find_duplicates(filename):
+    """Get the other members of an image's near-duplicate cluster."""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT other.filename, other.path, other.upload_date
+            FROM images AS img
+            JOIN images AS other ON other.cluster_id = img.cluster_id
+            WHERE img.filename = ? AND other.filename != img.filename
+            ORDER BY other.upload_date
+        ''', (filename,))
+        rows = cursor.fetchall()
+
+        conn.close()
+        return [{'filename': row[0], 'path': row[1], 'date': row[2]} for row in rows]
     except Exception as e:
-        print(f"Error finding similar images: {e}")
+        print(f"Error finding duplicates: {e}")
         return []
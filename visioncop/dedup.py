@@ -0,0 +1,98 @@
+"""
+Offline near-duplicate clustering over the whole indexed corpus.
+
+Candidate pairs come from blocked cosine similarity over the memory-mapped
+index snapshot (index.py), so neither the embeddings nor more than a
+block_size x block_size tile of scores is held in memory at a time. Candidates are then confirmed by pHash Hamming distance
+and grouped with union-find; the resulting clusters are written back to
+the database so "which images is this a copy of" becomes an index read.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from visioncop.database import get_image_hashes, set_image_hashes, save_duplicate_clusters
+from visioncop.index import get_index
+from visioncop.verification import calculate_image_hash
+
+def _hash_file(path):
+    """Worker: compute the pHash hex string for one file (None on failure)."""
+    phash = calculate_image_hash(path)
+    return str(phash) if phash is not None else None
+
+def compute_missing_hashes(workers=None):
+    """Compute and store pHashes for indexed images that don't have one yet."""
+    images = get_image_hashes()
+    missing = [(filename, info['path']) for filename, info in images.items()
+               if not info['phash'] and info['path'] and os.path.exists(info['path'])]
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            hashes = executor.map(_hash_file, [path for _, path in missing], chunksize=32)
+            computed = {filename: phash for (filename, _), phash in zip(missing, hashes) if phash}
+        set_image_hashes(computed)
+        for filename, phash in computed.items():
+            images[filename]['phash'] = phash
+
+    return {filename: info['phash'] for filename, info in images.items() if info['phash']}
+
+def generate_candidates(matrix, threshold=0.9, block_size=1024):
+    """Yield (i, j) row pairs with cosine similarity >= threshold, i < j."""
+    n = matrix.shape[0]
+    for start_i in range(0, n, block_size):
+        block_i = matrix[start_i:start_i + block_size]
+        # Only the upper triangle of tiles is needed
+        for start_j in range(start_i, n, block_size):
+            block_j = matrix[start_j:start_j + block_size]
+            scores = block_i @ block_j.T
+            rows, cols = np.nonzero(scores >= threshold)
+            for row, col in zip(rows + start_i, cols + start_j):
+                if row < col:
+                    yield int(row), int(col)
+
+def hash_distance(hash_a, hash_b):
+    """Hamming distance between two pHash hex strings."""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+def _find(parent, i):
+    """Union-find root lookup with path halving."""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def cluster_duplicates(similarity_threshold=0.9, max_hash_distance=10, block_size=1024, workers=None):
+    """
+    Run the dedup job: hash, generate candidates, confirm, cluster and store.
+    Returns the list of clusters (each a list of filenames, size >= 2).
+    """
+    hashes = compute_missing_hashes(workers=workers)
+
+    # Compacted, so the mapped snapshot holds every image; rows re-added
+    # since are masked and images added since wait for the next run
+    index = get_index(compact=True)
+    matrix = index['matrix']
+    filenames = index['filenames'][:index['base_rows']]
+    masked = set(index['masked'].tolist())
+
+    parent = list(range(len(filenames)))
+    for i, j in generate_candidates(matrix, similarity_threshold, block_size):
+        if i in masked or j in masked:
+            continue
+        hash_i = hashes.get(filenames[i])
+        hash_j = hashes.get(filenames[j])
+        if hash_i and hash_j and hash_distance(hash_i, hash_j) <= max_hash_distance:
+            root_i, root_j = _find(parent, i), _find(parent, j)
+            if root_i != root_j:
+                parent[root_j] = root_i
+
+    groups = {}
+    for i, filename in enumerate(filenames):
+        if i in masked:
+            continue
+        groups.setdefault(_find(parent, i), []).append(filename)
+    clusters = [members for members in groups.values() if len(members) > 1]
+
+    save_duplicate_clusters(clusters)
+    return clusters
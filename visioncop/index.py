@@ -0,0 +1,561 @@
+"""
+In-memory embedding index shared between server workers.
+
+The index is a base snapshot of the stored embeddings, written to INDEX_DIR
+as .npy files tagged with the database's index generation, plus the rows
+added since. Each worker memory-maps the same base files, so N workers
+share one copy through the page cache instead of each holding its own.
+
+add_image bumps the generation; a worker that notices only reads the rows
+with ids above the ones it already holds and appends them to small
+in-process buffers (an image re-added under the same filename masks its
+old row). Once the appended rows outgrow COMPACT_ROWS / COMPACT_RATIO,
+or when the layout changes (images deleted, a new projection), a worker
+writes a new base snapshot under an exclusive file lock and the others map
+it. Mapping takes the lock shared, so a snapshot's files cannot be removed
+halfway through being opened.
+
+Rows are kept in database id order next to their ids, so metadata filters
+resolve in SQLite to ids and map to rows by binary search.
+
+When region embeddings exist (VISIONCOP_REGIONS=1), the snapshot also
+holds a float16 region matrix plus the owning row of each region, stored
+contiguously per image so max-over-regions is a blocked segmented max.
+
+When a dimensionality-reduction projection has been fitted (reduction.py),
+the snapshot also holds a copy of it and the reduced vectors. Searches
+then scan the reduced matrix and re-score the best candidates at full
+dimension.
+"""
+
+import os
+import json
+import fcntl
+import threading
+import numpy as np
+
+from visioncop.database import (
+    get_embedding_blocks, get_embedding_rows, get_region_blocks, get_region_matrix, get_index_state,
+    get_filtered_ids
+)
+from visioncop.reduction import load_projection, save_projection, project
+
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "index")
+
+# Region rows converted to float32 and scored per step of a region search,
+# in a per-thread scratch block (4096 x 2048 float32 is 32 MiB)
+REGION_BLOCK_ROWS = 4096
+
+# Reduced-dimension candidates re-scored at full dimension, per requested result
+RERANK_FACTOR = 4
+
+# Appended rows kept in process before a new base snapshot is written:
+# at least COMPACT_ROWS, or COMPACT_RATIO of the base snapshot if larger
+COMPACT_ROWS = 4096
+COMPACT_RATIO = 0.1
+
+def _empty_index():
+    """Index state before any snapshot is mapped."""
+    return {
+        'generation': None,
+        'layout': None,
+        'last_id': 0,
+        'base_last_id': 0,
+        'base_rows': 0,
+        'filenames': [],
+        'ids': np.zeros(0, dtype=np.int64),
+        'positions': {},
+        'matrix': np.zeros((0, 0), dtype=np.float32),
+        'regions': np.zeros((0, 0), dtype=np.float16),
+        'owners': np.zeros(0, dtype=np.int32),
+        'projection': None,
+        'reduced': None,
+        # Rows added after the base snapshot, in growable buffers
+        'appended': {'ids': None, 'matrix': None, 'reduced': None, 'regions': None, 'owners': None},
+        'appended_rows': 0,
+        'appended_regions': 0,
+        # Rows superseded by a later row for the same filename
+        'masked': np.zeros(0, dtype=np.intp),
+    }
+
+_index = _empty_index()
+_refresh_lock = threading.Lock()
+_buffers = threading.local()
+
+def _snapshot_paths(generation):
+    """Embedding, filename, region and region-owner files for a snapshot generation."""
+    base = os.path.join(INDEX_DIR, f"embeddings.{generation}")
+    return f"{base}.npy", f"{base}.json", f"{base}.regions.npy", f"{base}.owners.npy"
+
+def _meta_path(generation):
+    """Metadata file (layout and last image id) marking a snapshot generation complete."""
+    return os.path.join(INDEX_DIR, f"embeddings.{generation}.meta.json")
+
+def _ids_path(generation):
+    """Database ids of a snapshot's rows, ascending like the rows themselves."""
+    return os.path.join(INDEX_DIR, f"embeddings.{generation}.ids.npy")
+
+def _reduced_paths(generation):
+    """Projection copy and reduced-vector files for a snapshot generation."""
+    base = os.path.join(INDEX_DIR, f"embeddings.{generation}")
+    return f"{base}.projection.npz", f"{base}.reduced.npy"
+
+def _save_array(path, array):
+    """Atomically write an array as .npy."""
+    with open(f"{path}.tmp", 'wb') as f:
+        np.save(f, array)
+    os.replace(f"{path}.tmp", path)
+
+def _locked(mode):
+    """Open the index lock file and take it in the given flock mode."""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    lock = open(os.path.join(INDEX_DIR, 'index.lock'), 'a')
+    fcntl.flock(lock, mode)
+    return lock
+
+def _build_snapshot():
+    """Write a base snapshot of the whole database; returns its metadata."""
+    generation, layout = get_index_state()
+    projection = load_projection()
+    count, dim, blocks = get_embedding_blocks()
+
+    # Embeddings stream from SQLite straight into the mapped file, so the
+    # build never holds the whole matrix (or its BLOBs) in memory
+    matrix_path = _snapshot_paths(generation)[0]
+    if count:
+        matrix = np.lib.format.open_memmap(f"{matrix_path}.tmp", mode='w+', dtype=np.float32, shape=(count, dim))
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    filenames = []
+    ids = np.empty(count, dtype=np.int64)
+    reduced = np.empty((count, projection['components'].shape[0]), dtype=np.float32) \
+        if projection is not None and count else None
+    for block_ids, block_files, block in blocks:
+        start = len(filenames)
+        ids[start:start + len(block)] = block_ids
+        matrix[start:start + len(block)] = block
+        if reduced is not None:
+            reduced[start:start + len(block)] = project(projection, block)
+        filenames.extend(block_files)
+
+    if count:
+        matrix.flush()
+        del matrix
+        os.replace(f"{matrix_path}.tmp", matrix_path)
+    else:
+        _save_array(matrix_path, matrix)
+
+    last_id = int(ids[-1]) if count else 0
+    _stream_regions(generation, filenames, last_id)
+
+    meta = {'generation': generation, 'layout': layout, 'last_id': last_id}
+    _write_snapshot(meta, filenames, ids, None, None, None, projection, reduced)
+    return meta
+
+def _stream_regions(generation, filenames, last_id):
+    """Write the region and owner files of a snapshot block by block from the database."""
+    _, _, regions_path, owners_path = _snapshot_paths(generation)
+    positions = {filename: i for i, filename in enumerate(filenames)}
+    count, dim, blocks = get_region_blocks(last_id)
+    if not count:
+        _save_array(regions_path, np.zeros((0, 0), dtype=np.float16))
+        _save_array(owners_path, np.zeros(0, dtype=np.int32))
+        return
+
+    regions = np.lib.format.open_memmap(f"{regions_path}.stream", mode='w+', dtype=np.float16, shape=(count, dim))
+    owners = np.lib.format.open_memmap(f"{owners_path}.stream", mode='w+', dtype=np.int32, shape=(count,))
+    written = 0
+    for region_files, region_counts, block in blocks:
+        # Tagged with their owner's row; regions of images missing from the rows are dropped
+        block_owners = np.repeat(np.array([positions.get(f, -1) for f in region_files], dtype=np.int32),
+                                 np.array(region_counts, dtype=np.intp))
+        keep = block_owners >= 0
+        kept = int(keep.sum())
+        regions[written:written + kept] = block[keep]
+        owners[written:written + kept] = block_owners[keep]
+        written += kept
+
+    regions.flush()
+    owners.flush()
+    if written < count:
+        # Rare: an image changed between the two reads, so the files are rewritten shorter
+        _save_array(regions_path, np.ascontiguousarray(regions[:written]))
+        _save_array(owners_path, np.ascontiguousarray(owners[:written]))
+        del regions, owners
+        os.remove(f"{regions_path}.stream")
+        os.remove(f"{owners_path}.stream")
+    else:
+        del regions, owners
+        os.replace(f"{regions_path}.stream", regions_path)
+        os.replace(f"{owners_path}.stream", owners_path)
+
+def _write_snapshot(meta, filenames, ids, matrix, regions, owners, projection=None, reduced=None):
+    """
+    Write the files for a snapshot and drop older generations; matrix (or
+    regions and owners) is None when those files are already in place.
+    Caller holds the lock exclusively.
+    """
+    generation = meta['generation']
+    matrix_path, names_path, regions_path, owners_path = _snapshot_paths(generation)
+
+    with open(f"{names_path}.tmp", 'w') as f:
+        json.dump(list(filenames), f)
+    os.replace(f"{names_path}.tmp", names_path)
+    _save_array(_ids_path(generation), np.ascontiguousarray(ids, dtype=np.int64))
+    if matrix is not None:
+        _save_array(matrix_path, np.ascontiguousarray(matrix, dtype=np.float32))
+    if regions is not None:
+        _save_array(regions_path, np.ascontiguousarray(regions, dtype=np.float16))
+        _save_array(owners_path, np.ascontiguousarray(owners, dtype=np.int32))
+
+    projection_path, reduced_path = _reduced_paths(generation)
+    if projection is not None and reduced is not None:
+        save_projection(projection, projection_path)
+        _save_array(reduced_path, np.ascontiguousarray(reduced, dtype=np.float32))
+    elif os.path.exists(reduced_path):
+        os.remove(reduced_path)
+
+    # Metadata last: it appearing marks the snapshot complete
+    meta_path = _meta_path(generation)
+    with open(f"{meta_path}.tmp", 'w') as f:
+        json.dump(meta, f)
+    os.replace(f"{meta_path}.tmp", meta_path)
+
+    # Workers still mapping an older snapshot keep its files alive until they refresh
+    for file in os.listdir(INDEX_DIR):
+        parts = file.split('.')
+        if parts[0] == 'embeddings' and parts[1].isdigit() and int(parts[1]) < generation:
+            try:
+                os.remove(os.path.join(INDEX_DIR, file))
+            except OSError:
+                pass
+
+def install_snapshot(state, filenames, matrix, regions, owners, projection=None, reduced=None):
+    """
+    Install ready-made index arrays (e.g. from an imported snapshot file) as
+    the base snapshot for an index state returned by replace_images, so
+    workers map them without rebuilding from the database. Rows must be in
+    database id order.
+    """
+    lock = _locked(fcntl.LOCK_EX)
+    try:
+        latest = _latest_snapshot(state['layout'])
+        if latest is None or latest['generation'] < state['generation']:
+            meta = {key: state[key] for key in ('generation', 'layout', 'last_id')}
+            # replace_images inserted the rows in order into an emptied table, so their ids are consecutive
+            ids = np.arange(state['last_id'] - len(filenames) + 1, state['last_id'] + 1, dtype=np.int64)
+            _write_snapshot(meta, filenames, ids, matrix, regions, owners, projection, reduced)
+    finally:
+        lock.close()
+
+def _latest_snapshot(layout):
+    """Metadata of the newest complete snapshot for a layout, or None."""
+    generations = []
+    for file in os.listdir(INDEX_DIR):
+        parts = file.split('.')
+        if len(parts) == 4 and parts[0] == 'embeddings' and parts[1].isdigit() and parts[2:] == ['meta', 'json']:
+            generations.append(int(parts[1]))
+
+    for generation in sorted(generations, reverse=True):
+        if not os.path.exists(_ids_path(generation)):
+            # Written before snapshots stored row ids; rebuilt instead
+            continue
+        with open(_meta_path(generation)) as f:
+            meta = json.load(f)
+        if meta['layout'] == layout:
+            return meta
+        if meta['layout'] < layout:
+            break
+    return None
+
+def _map_snapshot(generation):
+    """Map a snapshot's files into a fresh index state. Caller holds the lock."""
+    matrix_path, names_path, regions_path, owners_path = _snapshot_paths(generation)
+    with open(_meta_path(generation)) as f:
+        meta = json.load(f)
+    with open(names_path) as f:
+        filenames = json.load(f)
+
+    index = _empty_index()
+    index.update({
+        'layout': meta['layout'],
+        'last_id': meta['last_id'],
+        'base_last_id': meta['last_id'],
+        'base_rows': len(filenames),
+        'filenames': filenames,
+        'ids': np.load(_ids_path(generation), mmap_mode='r'),
+        'positions': {filename: i for i, filename in enumerate(filenames)},
+        'regions': np.load(regions_path, mmap_mode='r'),
+        'owners': np.load(owners_path, mmap_mode='r'),
+    })
+    if filenames:
+        index['matrix'] = np.load(matrix_path, mmap_mode='r')
+
+    projection_path, reduced_path = _reduced_paths(generation)
+    if os.path.exists(reduced_path):
+        index['projection'] = load_projection(projection_path)
+        index['reduced'] = np.load(reduced_path, mmap_mode='r')
+    return index
+
+def _adopt_latest(index, layout, build=False):
+    """
+    Switch to the newest snapshot for the layout if it is based on more rows
+    than the index's own. With build, a snapshot of the whole database is
+    written first when there is no such newer one.
+    """
+    lock = _locked(fcntl.LOCK_EX if build else fcntl.LOCK_SH)
+    try:
+        latest = _latest_snapshot(layout)
+        newer = latest is not None and (index['layout'] != layout or latest['last_id'] > index['base_last_id'])
+        if build and not newer:
+            latest = _build_snapshot()
+            newer = True
+        if newer:
+            index = _map_snapshot(latest['generation'])
+    finally:
+        lock.close()
+    return index
+
+def _outgrown(index):
+    """Whether the appended rows justify writing a new base snapshot."""
+    return index['appended_rows'] > max(COMPACT_ROWS, COMPACT_RATIO * index['base_rows'])
+
+def _grow(buffer, used, rows, dtype):
+    """Copy rows into a buffer after its first `used` rows, doubling its capacity as needed."""
+    if buffer is None or used + len(rows) > len(buffer):
+        grown = np.empty((max(64, 2 * (used + len(rows))),) + rows.shape[1:], dtype=dtype)
+        if buffer is not None:
+            grown[:used] = buffer[:used]
+        buffer = grown
+    buffer[used:used + len(rows)] = rows
+    return buffer
+
+def _append_rows(index):
+    """Append the rows added to the database since the index last read it."""
+    ids, filenames, matrix = get_embedding_rows(index['last_id'])
+    if not filenames:
+        return
+    region_files, region_counts, regions = get_region_matrix(index['last_id'])
+
+    start = len(index['filenames'])
+    positions = index['positions']
+    superseded = [positions[f] for f in filenames if f in positions]
+    for i, filename in enumerate(filenames):
+        positions[filename] = start + i
+    index['filenames'].extend(filenames)
+
+    appended = index['appended']
+    used = index['appended_rows']
+    appended['ids'] = _grow(appended['ids'], used, ids, np.int64)
+    appended['matrix'] = _grow(appended['matrix'], used, matrix, np.float32)
+    if index['projection'] is not None:
+        appended['reduced'] = _grow(appended['reduced'], used, project(index['projection'], matrix), np.float32)
+
+    # Regions read after the rows may belong to even newer rows; those wait for the next refresh
+    owners = np.repeat(np.array([positions.get(f, -1) for f in region_files], dtype=np.int32),
+                       np.array(region_counts, dtype=np.intp))
+    keep = owners >= start
+    if keep.any():
+        used_regions = index['appended_regions']
+        appended['regions'] = _grow(appended['regions'], used_regions, regions[keep], np.float16)
+        appended['owners'] = _grow(appended['owners'], used_regions, owners[keep], np.int32)
+        index['appended_regions'] = used_regions + int(keep.sum())
+
+    if superseded:
+        index['masked'] = np.union1d(index['masked'], superseded).astype(np.intp)
+    index['last_id'] = int(ids[-1])
+    # Searches size their view of the appended rows by this count, so it goes last
+    index['appended_rows'] = used + len(filenames)
+
+def get_index(compact=False):
+    """
+    Get the current index, appending rows other processes added since the
+    last call. With compact, the index is based on a snapshot that holds
+    every row it has (written first if needed).
+    """
+    global _index
+    generation, layout = get_index_state()
+    if generation == _index['generation'] and not (compact and _index['appended_rows']):
+        return _index
+
+    with _refresh_lock:
+        index = _index
+        if generation == index['generation'] and not (compact and index['appended_rows']):
+            return index
+
+        # Another worker may have written a newer snapshot; mapping it is cheap
+        index = _adopt_latest(index, layout)
+        if index['layout'] == layout:
+            _append_rows(index)
+
+        if index['layout'] != layout or compact and index['appended_rows'] or _outgrown(index):
+            index = _adopt_latest(index, layout, build=True)
+            _append_rows(index)
+
+        index['generation'] = generation
+        _index = index
+    return index
+
+def _pieces(index, key, count):
+    """(first row, array) of the base snapshot and the first count - base rows appended, for 'ids', 'matrix' or 'reduced'."""
+    pieces = []
+    if index['base_rows']:
+        pieces.append((0, index[key]))
+    if count > index['base_rows']:
+        pieces.append((index['base_rows'], index['appended'][key][:count - index['base_rows']]))
+    return pieces
+
+def _scores(index, key, vector, count, rows=None):
+    """Score the first count rows (or the given sorted rows) of a base + appended matrix against vectors."""
+    parts = []
+    for start, array in _pieces(index, key, count):
+        if rows is None:
+            parts.append(array @ vector)
+        else:
+            local = rows[(rows >= start) & (rows < start + len(array))] - start
+            parts.append(array[local] @ vector)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+
+def _row_count(index):
+    """Rows visible to a search, fixed when it starts."""
+    return index['base_rows'] + index['appended_rows']
+
+def _filtered_rows(index, count, source, labels, date_from, date_to):
+    """Index rows below count matching the metadata filters, or None when unfiltered."""
+    if not (source or labels or date_from or date_to):
+        return None
+    # Rows are in id order, so matching ids resolve to rows by binary search;
+    # superseded rows' ids are gone from the database and never match
+    ids = get_filtered_ids(source, labels, date_from, date_to)
+    parts = []
+    for start, row_ids in _pieces(index, 'ids', count):
+        local = np.minimum(np.searchsorted(row_ids, ids), len(row_ids) - 1)
+        parts.append(start + local[row_ids[local] == ids])
+    return np.concatenate(parts).astype(np.intp) if parts else np.zeros(0, dtype=np.intp)
+
+def _top_results(filenames, scores, top_k, rows=None):
+    """Turn per-row scores into the top_k result dicts, best first."""
+    valid = np.flatnonzero(np.isfinite(scores))
+    if len(valid) == 0:
+        return []
+    k = min(top_k, len(valid))
+    top = valid[np.argpartition(-scores[valid], k - 1)[:k]]
+    top = top[np.argsort(-scores[top])]
+
+    top_rows = rows[top] if rows is not None else top
+    return [{'filename': filenames[row], 'similarity': float(scores[i])} for row, i in zip(top_rows, top)]
+
+def _mask(index, scores, rows=None):
+    """Exclude superseded rows from scores of every row (or of the given rows)."""
+    masked = index['masked']
+    if rows is None:
+        scores[masked[masked < len(scores)]] = -np.inf
+    else:
+        scores[np.isin(rows, masked)] = -np.inf
+    return scores
+
+def find_similar_images(query_embedding, top_k=5, source=None, labels=None, date_from=None, date_to=None):
+    """
+    Find similar images with one matrix-vector product over the shared index.
+    Metadata filters are resolved in SQLite first and only matching rows are scored.
+    With a fitted projection, the reduced matrix is scanned and the top
+    RERANK_FACTOR * top_k candidates are re-scored at full dimension.
+    Returns None if the search itself failed, so it is not mistaken for
+    (and cached as) an empty result.
+    """
+    if query_embedding is None:
+        return []
+
+    try:
+        index = get_index()
+        total = _row_count(index)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        rows = _filtered_rows(index, total, source, labels, date_from, date_to)
+        count = total if rows is None else len(rows)
+        if count == 0:
+            return []
+
+        candidates = RERANK_FACTOR * top_k
+        if index['projection'] is not None and candidates < count:
+            approx = _scores(index, 'reduced', project(index['projection'], query), total, rows)
+            best = np.argpartition(-approx, candidates - 1)[:candidates]
+            # Sorted rows keep the full-dimension reads sequential in the mmap
+            candidate_rows = np.sort(best if rows is None else rows[best])
+            scores = _mask(index, _scores(index, 'matrix', query, total, candidate_rows), candidate_rows)
+            return _top_results(index['filenames'], scores, top_k, candidate_rows)
+
+        scores = _scores(index, 'matrix', query, total, rows)
+        if rows is None:
+            scores = _mask(index, scores)
+        return _top_results(index['filenames'], scores, top_k, rows)
+
+    except Exception as e:
+        print(f"Error searching index: {e}")
+        return None
+
+def _region_pieces(index, count):
+    """(regions, owners) of the base snapshot and of the appended rows below count."""
+    pieces = [(index['regions'], index['owners'])]
+    used = index['appended_regions']
+    if used:
+        owners = index['appended']['owners'][:used]
+        # Regions are stored in owner order, so rows appended after the search started are a suffix
+        used = int(np.searchsorted(owners, count))
+        pieces.append((index['appended']['regions'][:used], owners[:used]))
+    return pieces
+
+def _region_scratch(dim):
+    """A reusable (REGION_BLOCK_ROWS, dim) float32 block for the calling thread."""
+    scratch = getattr(_buffers, 'regions', None)
+    if scratch is None or scratch.shape[1] != dim:
+        scratch = _buffers.regions = np.empty((REGION_BLOCK_ROWS, dim), dtype=np.float32)
+    return scratch
+
+def find_similar_regions(query_regions, top_k=5, source=None, labels=None, date_from=None, date_to=None):
+    """
+    Crop-robust search: an image scores the best similarity between any query
+    region and any of its regions. Images indexed without regions fall back
+    to their global embedding against every query region.
+    Returns None if the search itself failed.
+    """
+    if query_regions is None:
+        return []
+
+    try:
+        index = get_index()
+        total = _row_count(index)
+        rows = _filtered_rows(index, total, source, labels, date_from, date_to)
+        if (total if rows is None else len(rows)) == 0:
+            return []
+
+        queries = np.asarray(query_regions, dtype=np.float32)
+        best = _scores(index, 'matrix', queries.T, total, rows).max(axis=1)
+
+        scratch = _region_scratch(queries.shape[1])
+        for regions, owners in _region_pieces(index, total):
+            selected = None
+            if rows is not None:
+                # Only the regions of matching images, gathered block by block
+                selected = np.flatnonzero(np.isin(owners, rows))
+                owners = np.searchsorted(rows, owners[selected])
+
+            # Blocked segmented max: regions are contiguous per owner
+            for start in range(0, len(owners), REGION_BLOCK_ROWS):
+                block_owners = owners[start:start + REGION_BLOCK_ROWS]
+                block = scratch[:len(block_owners)]
+                if selected is None:
+                    np.copyto(block, regions[start:start + REGION_BLOCK_ROWS])
+                else:
+                    np.copyto(block, regions[selected[start:start + REGION_BLOCK_ROWS]])
+                scores = (block @ queries.T).max(axis=1)
+                segments = np.flatnonzero(np.r_[True, block_owners[1:] != block_owners[:-1]])
+                segment_owners = block_owners[segments]
+                best[segment_owners] = np.maximum(best[segment_owners], np.maximum.reduceat(scores, segments))
+
+        if rows is None:
+            best = _mask(index, best)
+        return _top_results(index['filenames'], best, top_k, rows)
+
+    except Exception as e:
+        print(f"Error searching region index: {e}")
+        return None
@@ -0,0 +1,120 @@
+"""
+Streaming upload ingestion.
+
+Uploads are consumed chunk by chunk: the image signature is checked on the
+first bytes, the SHA-256 and size limit are updated as each chunk arrives,
+and a bad upload is rejected before it reaches the images directory. The
+accepted bytes are kept in one bounded buffer that is handed straight to
+the embedder, so nothing is read back from disk.
+"""
+
+import io
+import os
+import uuid
+import hashlib
+from PIL import Image
+
+CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+# Formats accepted from uploads, by PIL format name, and the extension
+# they are stored under. PIL's own header checks identify them.
+IMAGE_FORMATS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+    'GIF': '.gif',
+    'BMP': '.bmp',
+    'TIFF': '.tif',
+}
+SIGNATURE_BYTES = 16
+
+def detect_image_type(header):
+    """Get the file extension for an image header, or None if unsupported."""
+    Image.init()
+    for fmt, extension in IMAGE_FORMATS.items():
+        _, accept = Image.OPEN.get(fmt, (None, None))
+        # accept() returns a message string for recognised but unsupported variants
+        result = accept(header) if accept else None
+        if result and not isinstance(result, str):
+            return extension
+    return None
+
+def read_chunks(file_obj, chunk_size=CHUNK_SIZE):
+    """Iterate over a file-like object in fixed-size chunks."""
+    return iter(lambda: file_obj.read(chunk_size), b'')
+
+def ingest_chunks(chunks, dest_dir=None, filename=None, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Validate, hash and (optionally) store an upload as its chunks arrive.
+
+    Returns a dict with filename, path, sha256, size and data (a BytesIO
+    positioned at 0, ready for get_image_embedding). The stored name is
+    filename if given, else a uuid with the detected extension. With
+    dest_dir=None nothing is written to disk. Raises ValueError if the upload is rejected;
+    any partially written file is removed.
+    """
+    hasher = hashlib.sha256()
+    data = io.BytesIO()
+    extension = None
+    part_path = None
+    part_file = None
+    size = 0
+
+    try:
+        for chunk in chunks:
+            data.write(chunk)
+            size = data.tell()
+            if size > max_bytes:
+                raise ValueError(f"file exceeds {max_bytes // (1024 * 1024)} MB limit")
+            hasher.update(chunk)
+
+            if extension is None:
+                if size < SIGNATURE_BYTES:
+                    continue
+                extension = detect_image_type(data.getbuffer()[:SIGNATURE_BYTES].tobytes())
+                if extension is None:
+                    raise ValueError("not a supported image (JPEG, PNG, WebP, GIF, BMP or TIFF)")
+                if dest_dir:
+                    part_path = os.path.join(dest_dir, f".{uuid.uuid4()}.part")
+                    part_file = open(part_path, 'wb')
+                    part_file.write(data.getbuffer())
+                continue
+
+            if part_file:
+                part_file.write(chunk)
+
+        if extension is None:
+            raise ValueError("empty or truncated image")
+
+        # Parse the header and check structure without decoding pixels
+        data.seek(0)
+        try:
+            with Image.open(data) as img:
+                img.verify()
+        except Exception as e:
+            raise ValueError(f"invalid image: {e}")
+        data.seek(0)
+
+        filename = filename or f"{uuid.uuid4()}{extension}"
+        path = None
+        if part_file:
+            part_file.close()
+            part_file = None
+            path = os.path.join(dest_dir, filename)
+            os.replace(part_path, path)
+            part_path = None
+
+        return {
+            'filename': filename,
+            'path': path,
+            'sha256': hasher.hexdigest(),
+            'size': size,
+            'data': data,
+        }
+
+    finally:
+        if part_file:
+            part_file.close()
+        if part_path and os.path.exists(part_path):
+            os.remove(part_path)
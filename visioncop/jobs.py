@@ -0,0 +1,323 @@
+"""
+Local, persistent background indexing queue.
+
+Jobs and their items live in the same SQLite database as the index, so no
+external broker is needed and queued work survives restarts. Uploads are
+stored on disk and enqueued; worker processes (python run.py
+--index-workers N) claim items in batches, embed them with one batched
+forward pass and record progress, which the API and UIs poll.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import numpy as np
+from datetime import datetime
+import threading
+from multiprocessing import Process
+
+from visioncop import database
+from visioncop.database import init_database, add_image, add_image_regions
+
+# Claims before an item whose worker died is failed instead of requeued
+MAX_ATTEMPTS = 3
+
+# Seconds between checks for dead workers (stale claims, supervised processes)
+REQUEUE_INTERVAL = 30
+SUPERVISE_INTERVAL = 5
+
+# (stop event, thread) of each supervisor, keyed by id() of its worker list
+_supervisors = {}
+
+def _connect():
+    """Connection in autocommit mode so claims can use BEGIN IMMEDIATE."""
+    return sqlite3.connect(database.DB_PATH, timeout=30, isolation_level=None)
+
+def enqueue_images(items):
+    """
+    Create an indexing job for already-stored images.
+    items: list of dicts with filename, path and optional metadata.
+    Returns the new job id.
+    """
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('INSERT INTO index_jobs (status, total, created_at) VALUES (?, ?, ?)',
+                       ('queued', len(items), datetime.now().isoformat()))
+        job_id = cursor.lastrowid
+        cursor.executemany('''
+            INSERT INTO index_job_items (job_id, filename, path, metadata, status)
+            VALUES (?, ?, ?, ?, 'queued')
+        ''', [(job_id, item['filename'], item['path'],
+               json.dumps(item['metadata']) if item.get('metadata') else None) for item in items])
+        cursor.execute('COMMIT')
+        return job_id
+    finally:
+        conn.close()
+
+def _job_to_dict(row):
+    """Convert an index_jobs row into a status dict with progress and throughput."""
+    job_id, status, total, completed, failed, created_at, started_at, finished_at = row
+    processed = completed + failed
+    throughput = 0.0
+    if started_at and processed:
+        end = datetime.fromisoformat(finished_at) if finished_at else datetime.now()
+        elapsed = (end - datetime.fromisoformat(started_at)).total_seconds()
+        throughput = processed / elapsed if elapsed > 0 else 0.0
+
+    return {
+        'job_id': job_id,
+        'status': status,
+        'total': total,
+        'completed': completed,
+        'failed': failed,
+        'progress': processed / total if total else 1.0,
+        'images_per_second': round(throughput, 2),
+        'created_at': created_at,
+        'started_at': started_at,
+        'finished_at': finished_at
+    }
+
+def get_job(job_id):
+    """Get status and progress for a job, or None if it doesn't exist."""
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM index_jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        job = _job_to_dict(row)
+        cursor.execute("SELECT filename, error FROM index_job_items WHERE job_id = ? AND status = 'failed'", (job_id,))
+        job['errors'] = [f"{filename}: {error}" for filename, error in cursor.fetchall()]
+        return job
+    finally:
+        conn.close()
+
+def get_recent_jobs(limit=20):
+    """Get the most recent jobs, newest first."""
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM index_jobs ORDER BY id DESC LIMIT ?', (limit,))
+        return [_job_to_dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def get_job_filenames(job_id):
+    """Get the filenames that were indexed successfully by a job."""
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT filename FROM index_job_items WHERE job_id = ? AND status = 'done'", (job_id,))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def claim_items(batch_size):
+    """Atomically claim up to batch_size queued items for this process."""
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT id, job_id, filename, path, metadata FROM index_job_items
+            WHERE status = 'queued' ORDER BY id LIMIT ?
+        ''', (batch_size,))
+        rows = cursor.fetchall()
+
+        if rows:
+            cursor.executemany("UPDATE index_job_items SET status = 'running', worker_pid = ?, "
+                               "attempts = COALESCE(attempts, 0) + 1 WHERE id = ?",
+                               [(os.getpid(), row[0]) for row in rows])
+            job_ids = sorted({row[1] for row in rows})
+            cursor.execute(f'''
+                UPDATE index_jobs SET status = 'running', started_at = COALESCE(started_at, ?)
+                WHERE id IN ({','.join('?' * len(job_ids))})
+            ''', [datetime.now().isoformat()] + job_ids)
+        cursor.execute('COMMIT')
+
+        return [{
+            'id': row[0],
+            'job_id': row[1],
+            'filename': row[2],
+            'path': row[3],
+            'metadata': json.loads(row[4]) if row[4] else None
+        } for row in rows]
+    finally:
+        conn.close()
+
+def _record_results(cursor, results):
+    """Write item outcomes [(item, error_or_None)] and finish jobs that are complete."""
+    for item, error in results:
+        cursor.execute('UPDATE index_job_items SET status = ?, error = ? WHERE id = ?',
+                       ('failed' if error else 'done', error, item['id']))
+        column = 'failed' if error else 'completed'
+        cursor.execute(f'UPDATE index_jobs SET {column} = {column} + 1 WHERE id = ?', (item['job_id'],))
+
+    job_ids = sorted({item['job_id'] for item, _ in results})
+    if job_ids:
+        cursor.execute(f'''
+            UPDATE index_jobs
+            SET status = CASE WHEN completed = 0 THEN 'failed' ELSE 'done' END, finished_at = ?
+            WHERE id IN ({','.join('?' * len(job_ids))}) AND completed + failed >= total
+        ''', [datetime.now().isoformat()] + job_ids)
+
+def complete_items(results):
+    """Record item outcomes [(item, error_or_None)] and update job progress."""
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        _record_results(cursor, results)
+        cursor.execute('COMMIT')
+    finally:
+        conn.close()
+
+def requeue_stale_items():
+    """
+    Put back items claimed by workers that are no longer running. Items
+    that were already claimed MAX_ATTEMPTS times are failed instead, so an
+    image that crashes workers cannot take down every restarted worker.
+    """
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute("SELECT DISTINCT worker_pid FROM index_job_items WHERE status = 'running'")
+        dead = []
+        for (pid,) in cursor.fetchall():
+            try:
+                os.kill(pid, 0)
+            except (OSError, TypeError):
+                dead.append(pid)
+
+        for pid in dead:
+            cursor.execute("SELECT id, job_id FROM index_job_items WHERE status = 'running' "
+                           "AND worker_pid IS ? AND COALESCE(attempts, 0) >= ?", (pid, MAX_ATTEMPTS))
+            _record_results(cursor, [({'id': item_id, 'job_id': job_id}, 'worker died while indexing this image')
+                                     for item_id, job_id in cursor.fetchall()])
+            cursor.execute("UPDATE index_job_items SET status = 'queued', worker_pid = NULL "
+                           "WHERE status = 'running' AND worker_pid IS ?", (pid,))
+        cursor.execute('COMMIT')
+    finally:
+        conn.close()
+
+def _index_batch(items, output):
+    """Embed and store one claimed batch; returns [(item, error_or_None)]."""
+    from visioncop.models import get_image_embeddings, get_region_embeddings, REGION_EMBEDDINGS
+    from visioncop.verification import extract_exif_record
+
+    paths = [item['path'] for item in items]
+    if REGION_EMBEDDINGS:
+        # The first region is the whole image, i.e. the global embedding
+        region_sets = get_region_embeddings(paths)
+        embeddings = [regions[0] if regions is not None else None for regions in region_sets]
+    else:
+        region_sets = [None] * len(items)
+        embeddings = get_image_embeddings(paths, batch_size=len(items), out=output[:len(items)])
+
+    results = []
+    for item, embedding, regions in zip(items, embeddings, region_sets):
+        # Keep the compared EXIF fields so verification needn't reopen the file
+        try:
+            item['metadata'] = dict(item['metadata'] or {}, exif=extract_exif_record(item['path']))
+        except Exception as e:
+            print(f"Error reading EXIF for {item['filename']}: {e}")
+
+        if embedding is None:
+            results.append((item, 'could not compute embedding'))
+        elif regions is not None and not add_image_regions(item['filename'], regions):
+            results.append((item, 'database write failed'))
+        elif not add_image(item['filename'], embedding, item['metadata']):
+            results.append((item, 'database write failed'))
+        else:
+            results.append((item, None))
+    return results
+
+def run_worker(batch_size=16, poll_interval=1.0, stop_when_idle=False):
+    """Claim and index queued items in batches until stopped (or idle)."""
+    from visioncop.models import EMBEDDING_DIM
+
+    init_database()
+    requeue_stale_items()
+    last_requeue = time.monotonic()
+
+    # Embedding rows are written to the database before the next batch, so
+    # one output matrix serves the worker's whole lifetime
+    output = np.empty((batch_size, EMBEDDING_DIM), dtype=np.float32)
+
+    while True:
+        # Pick up work left behind by workers that died since startup
+        if time.monotonic() - last_requeue > REQUEUE_INTERVAL:
+            requeue_stale_items()
+            last_requeue = time.monotonic()
+
+        items = claim_items(batch_size)
+        if not items:
+            if stop_when_idle:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        start = time.perf_counter()
+        try:
+            results = _index_batch(items, output)
+        except Exception as e:
+            # A failing batch must not take the worker (and its claims) down with it
+            print(f"Error indexing batch: {e}")
+            results = [(item, f'indexing failed: {e}') for item in items]
+        complete_items(results)
+
+        elapsed = time.perf_counter() - start
+        indexed = sum(1 for _, error in results if error is None)
+        print(f"⚙️ Worker {os.getpid()}: indexed {indexed}/{len(items)} images in {elapsed:.2f}s "
+              f"({len(items) / elapsed:.1f} img/s)")
+
+def _worker_main(batch_size):
+    """Process entry point that exits quietly on Ctrl+C."""
+    try:
+        run_worker(batch_size=batch_size)
+    except KeyboardInterrupt:
+        pass
+
+def _supervise(workers, batch_size, stopping):
+    """Replace workers that exit unexpectedly (e.g. killed by a crashing image)."""
+    while not stopping.wait(SUPERVISE_INTERVAL):
+        for i, worker in enumerate(workers):
+            # Exit code 0 is a clean shutdown (e.g. Ctrl+C), not a crash
+            if not worker.is_alive() and worker.exitcode != 0 and not stopping.is_set():
+                print(f"⚠️ Index worker {worker.pid} exited with code {worker.exitcode}; restarting it")
+                workers[i] = Process(target=_worker_main, args=(batch_size,), daemon=True)
+                workers[i].start()
+
+def start_workers(count=1, batch_size=16):
+    """
+    Start index worker processes in the background and return them. A
+    supervisor thread restarts workers that die; stop them with stop_workers.
+    """
+    init_database()
+    workers = [Process(target=_worker_main, args=(batch_size,), daemon=True) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+
+    stopping = threading.Event()
+    supervisor = threading.Thread(target=_supervise, args=(workers, batch_size, stopping), daemon=True)
+    supervisor.start()
+    _supervisors[id(workers)] = (stopping, supervisor)
+    return workers
+
+def stop_workers(workers):
+    """Stop workers started by start_workers (and their supervisor)."""
+    supervisor = _supervisors.pop(id(workers), None)
+    if supervisor is not None:
+        stopping, thread = supervisor
+        stopping.set()
+        thread.join()
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,255 @@
+"""
+Load generator for the FastAPI service.
+
+Drives a mix of /upload, /search and /images requests from N concurrent
+asyncio clients, either against the app in-process (httpx ASGI transport,
+isolated scratch data directory) or against a running server over
+localhost. Requests use synthetic JPEGs, so no dataset, GPU or network is
+needed; with VISIONCOP_RANDOM_WEIGHTS=1 the model is randomly initialized
+instead of downloaded.
+
+Reports throughput, latency percentiles and error rates per request type,
+plus CPU and RSS of the serving process tree sampled over time (Linux /proc).
+"""
+
+import os
+import time
+import random
+import asyncio
+import shutil
+import tempfile
+import numpy as np
+
+from visioncop.benchmark import make_synthetic_jpegs
+
+DEFAULT_MIX = {'search': 6, 'image': 3, 'upload': 1}
+
+# Distinct synthetic images cycled through by uploads and searches
+IMAGE_POOL_SIZE = 32
+IMAGE_SIZE = (1024, 768)
+
+PERCENTILES = [50, 90, 99]
+
+def parse_mix(text):
+    """Parse "search=6,image=3,upload=1" into request weights."""
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"Unknown request type '{kind}' (expected {', '.join(DEFAULT_MIX)})")
+        mix[kind] = float(weight) if weight else 1.0
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError("Request mix needs at least one positive weight")
+    return mix
+
+def _process_tree(pid):
+    """pid and all of its descendants (e.g. gunicorn workers)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+def _sample_usage(pid):
+    """Total (CPU seconds, RSS bytes) of a process tree."""
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    cpu = rss = 0
+    for process in _process_tree(pid):
+        try:
+            with open(f'/proc/{process}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{process}/statm') as f:
+                resident = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += resident * page_size
+    return cpu, rss
+
+async def _monitor(pid, interval, samples, stop):
+    """Append {'t', 'cpu_percent', 'rss_mb'} samples until stop is set."""
+    start = last_time = time.perf_counter()
+    last_cpu, _ = _sample_usage(pid)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        now = time.perf_counter()
+        cpu, rss = _sample_usage(pid)
+        samples.append({
+            't': now - start,
+            'cpu_percent': 100 * (cpu - last_cpu) / max(now - last_time, 1e-9),
+            'rss_mb': rss / 1024 / 1024,
+        })
+        last_time, last_cpu = now, cpu
+
+def _failed(response):
+    """The API reports most failures as 200 with success=false or an error key."""
+    if response.status_code >= 400:
+        return True
+    if response.headers.get('content-type', '').startswith('application/json'):
+        body = response.json()
+        return isinstance(body, dict) and (body.get('success') is False or 'error' in body)
+    return False
+
+async def _send(client, kind, images, filenames, rng):
+    """Send one request of the given kind; returns True on success."""
+    if kind == 'image':
+        if not filenames:
+            return False
+        response = await client.get(f'/images/{rng.choice(filenames)}', params={'size': 'thumb'})
+        return not _failed(response)
+
+    image = rng.choice(images)
+    files = {'file': ('loadtest.jpg', image, 'image/jpeg')}
+    if kind == 'search':
+        response = await client.post('/search', files=files)
+        return not _failed(response)
+
+    # Inline indexing, so the embedding cost is part of the measured request
+    response = await client.post('/upload', params={'background': 'false'}, files=files)
+    if _failed(response):
+        return False
+    filenames.append(response.json()['filename'])
+    return True
+
+async def _client(client, deadline, mix, images, filenames, latencies, errors, rng):
+    """One simulated user issuing back-to-back requests until the deadline."""
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    while time.perf_counter() < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        start = time.perf_counter()
+        try:
+            ok = await _send(client, kind, images, filenames, rng)
+        except Exception:
+            ok = False
+        latencies[kind].append(time.perf_counter() - start)
+        if not ok:
+            errors[kind] += 1
+
+def _isolate_in_process(workdir):
+    """Point the in-process app at a scratch directory instead of the real index."""
+    from visioncop import app as api, index, reduction, thumbnails
+    from visioncop.database import init_database
+
+    os.chdir(workdir)
+    api.DATA_PATH = os.path.join(workdir, 'images')
+    index.INDEX_DIR = os.path.join(workdir, 'index')
+    reduction.PROJECTION_PATH = os.path.join(workdir, 'index', 'projection.npz')
+    thumbnails.CACHE_DIR = os.path.join(workdir, 'cache')
+    os.makedirs(api.DATA_PATH, exist_ok=True)
+    init_database()
+    return api.app
+
+def _summarize(latencies, errors, elapsed):
+    """Per-kind and overall throughput, error rate and latency percentiles."""
+    report = {}
+    for kind in list(latencies) + ['total']:
+        values = sum(latencies.values(), []) if kind == 'total' else latencies[kind]
+        failed = sum(errors.values()) if kind == 'total' else errors[kind]
+        if not values:
+            continue
+        millis = np.array(values) * 1000
+        report[kind] = {
+            'requests': len(values),
+            'throughput': len(values) / elapsed,
+            'error_rate': failed / len(values),
+            'latency_ms': {f'p{p}': float(np.percentile(millis, p)) for p in PERCENTILES},
+        }
+    return report
+
+async def run_load_test(base_url=None, concurrency=8, duration=30.0, mix=None, seed_images=8,
+                        pid=None, sample_interval=1.0, seed=0):
+    """
+    Run a load test and return {'requests': per-kind stats, 'resources': samples}.
+    base_url=None drives the app in-process (resources sampled from this
+    process); otherwise resources are sampled from pid when given.
+    """
+    import httpx
+
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    images = make_synthetic_jpegs(IMAGE_POOL_SIZE, IMAGE_SIZE, seed=seed)
+
+    if base_url:
+        client = httpx.AsyncClient(base_url=base_url, timeout=None)
+    else:
+        original_dir = os.getcwd()
+        workdir = tempfile.mkdtemp(prefix='visioncop-loadtest-')
+        transport = httpx.ASGITransport(app=_isolate_in_process(workdir))
+        client = httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=None)
+        pid = os.getpid()
+
+    try:
+        report = await _drive(client, concurrency, duration, mix, images, seed_images, pid, sample_interval, seed, rng)
+    finally:
+        if not base_url:
+            os.chdir(original_dir)
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+async def _drive(client, concurrency, duration, mix, images, seed_images, pid, sample_interval, seed, rng):
+    """Seed the index, then run the timed load and collect the report."""
+    async with client:
+        # Seed the index so searches and image requests have targets
+        filenames = []
+        for _ in range(seed_images):
+            await _send(client, 'upload', images, filenames, rng)
+
+        latencies = {kind: [] for kind in mix}
+        errors = {kind: 0 for kind in mix}
+        samples = []
+        stop = asyncio.Event()
+        monitor = asyncio.create_task(_monitor(pid, sample_interval, samples, stop)) if pid else None
+
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*[
+            _client(client, deadline, mix, images, filenames, latencies, errors, random.Random(seed + i + 1))
+            for i in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        if monitor:
+            await monitor
+
+    return {
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'seeded': len(filenames),
+        'requests': _summarize(latencies, errors, elapsed),
+        'resources': samples,
+    }
+
+def load_test(base_url=None, concurrency=8, duration=30.0, mix=None, seed_images=8, pid=None):
+    """Run a load test and print the report."""
+    target = base_url or 'in-process app'
+    print(f"🎯 {target}: {concurrency} clients for {duration:.0f}s, mix {mix or DEFAULT_MIX}")
+
+    report = asyncio.run(run_load_test(base_url, concurrency, duration, mix, seed_images, pid))
+
+    if report['seeded'] == 0:
+        print("⚠️ Seeding uploads failed; image requests will all error")
+    for kind, stats in report['requests'].items():
+        latency = ', '.join(f"{name} {ms:.0f}ms" for name, ms in stats['latency_ms'].items())
+        print(f"📊 {kind:<7} {stats['requests']:>6} req  {stats['throughput']:>7.1f} req/s  "
+              f"errors {stats['error_rate'] * 100:5.1f}%  ({latency})")
+
+    for sample in report['resources']:
+        print(f"🖥️ t={sample['t']:>5.1f}s  CPU {sample['cpu_percent']:>6.1f}%  RSS {sample['rss_mb']:>7.1f} MB")
+    return report
@@ -1,22 +1,57 @@
-import torch
-import torch.nn as nn
-import torchvision.models as models
-import torchvision.transforms as transforms
 from PIL import Image
 import numpy as np
 import os
+import threading
+
+# torch and torchvision take seconds to import, so they are imported inside
+# the functions that need them; importing this module stays cheap for CLI
+# commands, health checks and DB-only tools
+
+# Skip the pretrained weight download (same compute, meaningless embeddings);
+# for offline load tests and benchmarks only
+RANDOM_WEIGHTS = os.environ.get("VISIONCOP_RANDOM_WEIGHTS") == "1"
 
 # Global model instance
 model = None
 transforms_img = None
 
+# ResNet50 embedding size (pooled features before the classifier)
+EMBEDDING_DIM = 2048
+
+# Per-thread reusable input batch (see _input_batch)
+_buffers = threading.local()
+
+# Preprocessing geometry and ImageNet statistics used by transforms_img
+RESIZE_SIZE = 256
+CROP_SIZE = 224
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# Normalization folded into uint8 space: (x / 255 - mean) / std == (x - 255 * mean) / (255 * std)
+_SHIFT = None
+_SCALE = None
+
+def _normalization():
+    """Per-channel (shift, scale) tensors, created on first use."""
+    global _SHIFT, _SCALE
+    import torch
+
+    if _SHIFT is None:
+        _SHIFT = torch.tensor([255 * m for m in MEAN]).view(3, 1, 1)
+        _SCALE = torch.tensor([255 * s for s in STD]).view(3, 1, 1)
+    return _SHIFT, _SCALE
+
 def load_resnet_model():
     """Load ResNet50 model for image embeddings."""
     global model, transforms_img
 
     if model is None:
-        # Load pre-trained ResNet50
-        model = models.resnet50(pretrained=True)
+        import torch
+        import torch.nn as nn
+        import torchvision.models as models
+
+        # Load pre-trained ResNet50 (random init with VISIONCOP_RANDOM_WEIGHTS=1)
+        model = models.resnet50(pretrained=not RANDOM_WEIGHTS)
         # Remove the final classification layer to get embeddings
         model = nn.Sequential(*list(model.children())[:-1])
         model.eval()
@@ -26,37 +61,235 @@ def load_resnet_model():
         model = model.to(device)
 
         # Define image preprocessing
-        transforms_img = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
+        transforms_img = build_reference_transform()
 
     return model, transforms_img
 
-def get_image_embedding(image_path):
-    """Extract embedding from image using ResNet."""
-    try:
-        model, transform = load_resnet_model()
+def build_reference_transform():
+    """
+    Reference torchvision preprocessing. get_image_embedding uses the faster
+    preprocess_image path, which stays numerically close to this.
+    """
+    import torchvision.transforms as transforms
 
-        # Load and preprocess image
-        image = Image.open(image_path).convert('RGB')
-        image = transform(image).unsqueeze(0)
+    return transforms.Compose([
+        transforms.Resize(RESIZE_SIZE),
+        transforms.CenterCrop(CROP_SIZE),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=MEAN, std=STD),
+    ])
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        image = image.to(device)
+def load_image(image_source, min_side=RESIZE_SIZE):
+    """
+    Open an image (path or file-like) as RGB, letting the JPEG decoder
+    downscale via DCT scaling so the shorter side is still >= min_side.
+    """
+    image = Image.open(image_source)
+    width, height = image.size
+    scale = min_side / min(width, height)
+    if scale < 1:
+        # draft() only reduces by powers of two and never below the requested size
+        image.draft('RGB', (int(width * scale + 1), int(height * scale + 1)))
+    return image.convert('RGB')
+
+def preprocess_image(image, out=None):
+    """
+    Resize, center-crop and normalize a PIL image into a (3, 224, 224) tensor.
+
+    Equivalent to transforms_img, but the uint8 pixels are converted and
+    normalized in place in a single float buffer (optionally `out`).
+    """
+    import torch
+
+    # Same output geometry as transforms.Resize(256) + CenterCrop(224)
+    width, height = image.size
+    if width <= height:
+        new_size = (RESIZE_SIZE, int(RESIZE_SIZE * height / width))
+    else:
+        new_size = (int(RESIZE_SIZE * width / height), RESIZE_SIZE)
+    if new_size != image.size:
+        # reducing_gap lets Pillow do a cheap integer box reduction first
+        image = image.resize(new_size, Image.BILINEAR, reducing_gap=3.0)
+
+    left = int(round((new_size[0] - CROP_SIZE) / 2.0))
+    top = int(round((new_size[1] - CROP_SIZE) / 2.0))
+    image = image.crop((left, top, left + CROP_SIZE, top + CROP_SIZE))
 
-        # Get embedding
-        with torch.no_grad():
-            embedding = model(image)
+    pixels = torch.from_numpy(np.array(image)).permute(2, 0, 1)
+    if out is None:
+        out = torch.empty((3, CROP_SIZE, CROP_SIZE), dtype=torch.float32)
+    shift, scale = _normalization()
+    out.copy_(pixels)
+    out.sub_(shift).div_(scale)
+    return out
 
-        # Flatten and normalize
-        embedding = embedding.cpu().numpy().flatten()
-        embedding = embedding / np.linalg.norm(embedding)
+def _input_batch(rows):
+    """
+    A reusable (rows, 3, 224, 224) input buffer for the calling thread,
+    page-locked when CUDA is available so host-to-device copies can be async.
+    Grows to the largest batch seen instead of being allocated per call.
+    """
+    import torch
 
-        return embedding
+    buffer = getattr(_buffers, 'batch', None)
+    if buffer is None or buffer.shape[0] < rows:
+        buffer = torch.empty((rows, 3, CROP_SIZE, CROP_SIZE), dtype=torch.float32,
+                             pin_memory=torch.cuda.is_available())
+        _buffers.batch = buffer
+    return buffer[:rows]
+
+def _embed_batch(model, batch, device, out):
+    """Forward a preprocessed batch and write L2-normalized embeddings into out (rows x dim)."""
+    import torch
+
+    with torch.no_grad():
+        output = model(batch.to(device, non_blocking=True)).flatten(1)
+        output.div_(torch.linalg.vector_norm(output, dim=1, keepdim=True))
+    # Copy straight into the caller's float32 rows; no intermediate arrays
+    torch.from_numpy(out).copy_(output)
+    return out
+
+def get_image_embedding(image_path):
+    """Extract embedding from image (path or file-like object) using ResNet."""
+    import torch
+
+    try:
+        model, _ = load_resnet_model()
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        # Preprocess into the thread's reusable input buffer
+        batch = _input_batch(1)
+        preprocess_image(load_image(image_path), out=batch[0])
+
+        embedding = np.empty((1, EMBEDDING_DIM), dtype=np.float32)
+        return _embed_batch(model, batch, device, embedding)[0]
 
     except Exception as e:
         print(f"Error getting embedding: {e}")
         return None
+
+def get_image_embeddings(image_paths, batch_size=16, out=None):
+    """
+    Extract embeddings for many images with batched forward passes.
+    Returns a list aligned with image_paths (None for images that failed).
+    Embeddings are rows of one preallocated (len(image_paths), dim) matrix;
+    pass `out` to reuse a matrix across calls (e.g. per worker batch), in
+    which case the rows are only valid until the next call.
+    """
+    import torch
+
+    model, _ = load_resnet_model()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if out is None:
+        out = np.empty((len(image_paths), EMBEDDING_DIM), dtype=np.float32)
+    embeddings = [None] * len(image_paths)
+
+    for start in range(0, len(image_paths), batch_size):
+        batch = _input_batch(min(batch_size, len(image_paths) - start))
+        loaded = []
+        for offset, image_path in enumerate(image_paths[start:start + batch_size]):
+            try:
+                preprocess_image(load_image(image_path), out=batch[len(loaded)])
+                loaded.append(start + offset)
+            except Exception as e:
+                print(f"Error loading {image_path}: {e}")
+
+        if not loaded:
+            continue
+
+        try:
+            # Loaded rows are packed at the front of the batch; write them
+            # to out[start:] and move any rows after a failed image into place
+            rows = out[start:start + len(loaded)]
+            _embed_batch(model, batch[:len(loaded)], device, rows)
+            for row, index in reversed(list(enumerate(loaded))):
+                if index != start + row:
+                    out[index] = out[start + row]
+                embeddings[index] = out[index]
+        except Exception as e:
+            print(f"Error getting embeddings: {e}")
+
+    return embeddings
+
+# Optional multi-region mode: each image is also embedded as overlapping crops
+# so cropped or partially pasted copies still match one of its regions
+REGION_EMBEDDINGS = os.environ.get("VISIONCOP_REGIONS") == "1"
+
+# Region boxes as (left, top, right, bottom) fractions; the first is the
+# whole image, so its embedding equals get_image_embedding's
+REGION_BOXES = [
+    (0.0, 0.0, 1.0, 1.0),
+    (0.0, 0.0, 0.6, 0.6),
+    (0.4, 0.0, 1.0, 0.6),
+    (0.0, 0.4, 0.6, 1.0),
+    (0.4, 0.4, 1.0, 1.0),
+    (0.2, 0.2, 0.8, 0.8),
+]
+
+# Regions smaller than this (in source pixels) are skipped, except the whole image
+MIN_REGION_SIDE = 32
+
+def get_region_embeddings(image_paths, batch_size=32):
+    """
+    Extract one embedding per REGION_BOXES crop for many images, batching
+    region forward passes across images. Returns a list aligned with
+    image_paths of (regions, dim) arrays (None on failure). The first row
+    is always the whole image; crops below MIN_REGION_SIDE are left out, so
+    very small images have fewer rows.
+    """
+    import torch
+
+    model, _ = load_resnet_model()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Decode large enough that the smallest region still fills RESIZE_SIZE
+    min_side = int(RESIZE_SIZE / min(min(r - l, b - t) for l, t, r, b in REGION_BOXES)) + 1
+
+    region_count = len(REGION_BOXES)
+    results = [None] * len(image_paths)
+    # One output block for the call; regions go straight to (image, region) slots
+    out = np.empty((len(image_paths), region_count, EMBEDDING_DIM), dtype=np.float32)
+    staged = np.empty((batch_size, EMBEDDING_DIM), dtype=np.float32)
+    batch = _input_batch(batch_size)
+    owners = []
+    slots = []
+
+    def flush():
+        _embed_batch(model, batch[:len(owners)], device, staged[:len(owners)])
+        out[owners, slots] = staged[:len(owners)]
+        owners.clear()
+        slots.clear()
+
+    kept_slots = {}
+    for index, image_path in enumerate(image_paths):
+        # Rows of this image still waiting in the batch start here
+        first = len(owners)
+        kept = []
+        try:
+            image = load_image(image_path, min_side=min_side)
+            width, height = image.size
+            for slot, (left, top, right, bottom) in enumerate(REGION_BOXES):
+                box = (int(left * width), int(top * height), int(right * width), int(bottom * height))
+                # Tiny images still get the whole-image region, but no degenerate crops
+                if slot and min(box[2] - box[0], box[3] - box[1]) < MIN_REGION_SIDE:
+                    continue
+                preprocess_image(image.crop(box), out=batch[len(owners)])
+                owners.append(index)
+                slots.append(slot)
+                kept.append(slot)
+                if len(owners) == batch_size:
+                    flush()
+                    first = 0
+        except Exception as e:
+            print(f"Error embedding regions of {image_path}: {e}")
+            # Drop this image's staged rows; rows already embedded are simply unused
+            del owners[first:]
+            del slots[first:]
+            continue
+        kept_slots[index] = kept
+
+    if owners:
+        flush()
+
+    for index, kept in kept_slots.items():
+        results[index] = out[index] if len(kept) == region_count else out[index, kept]
+    return results
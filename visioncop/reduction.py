@@ -0,0 +1,121 @@
+"""
+Dimensionality reduction for the 2048-d ResNet50 embeddings.
+
+A projection (PCA with optional whitening, or Gaussian random projection)
+is fitted on the stored embeddings and saved next to the index. When one
+exists, index snapshots also hold the reduced vectors: searches scan the
+small matrix and re-score only the best candidates at full dimension, so
+the full matrix is touched for a handful of rows per query.
+"""
+
+import os
+import numpy as np
+
+PROJECTION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "index", "projection.npz")
+
+# Rows used to fit PCA; the covariance is exact enough well before this
+MAX_FIT_SAMPLES = 50000
+
+def fit_pca(matrix, dim, whiten=False, seed=0):
+    """Fit a PCA projection to dim components (whitened if requested)."""
+    rng = np.random.default_rng(seed)
+    if matrix.shape[0] > MAX_FIT_SAMPLES:
+        matrix = matrix[np.sort(rng.choice(matrix.shape[0], MAX_FIT_SAMPLES, replace=False))]
+    matrix = np.asarray(matrix, dtype=np.float64)
+    dim = min(dim, matrix.shape[0], matrix.shape[1])
+
+    mean = matrix.mean(axis=0)
+    centered = matrix - mean
+    covariance = centered.T @ centered / max(1, matrix.shape[0] - 1)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1][:dim]
+
+    components = eigenvectors[:, order].T
+    if whiten:
+        components = components / np.sqrt(np.maximum(eigenvalues[order], 1e-12))[:, None]
+
+    return {
+        'method': 'pca',
+        'whiten': whiten,
+        'mean': mean.astype(np.float32),
+        'components': components.astype(np.float32),
+    }
+
+def fit_random_projection(input_dim, dim, seed=0):
+    """Gaussian random projection (Johnson-Lindenstrauss) to dim components."""
+    rng = np.random.default_rng(seed)
+    return {
+        'method': 'random',
+        'whiten': False,
+        'mean': np.zeros(input_dim, dtype=np.float32),
+        'components': (rng.standard_normal((dim, input_dim)) / np.sqrt(dim)).astype(np.float32),
+    }
+
+def project(projection, vectors):
+    """Project vectors (n x D or D) and L2-normalize so dot products stay cosines."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    reduced = (vectors - projection['mean']) @ projection['components'].T
+    norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+    return reduced / np.maximum(norms, 1e-12)
+
+def save_projection(projection, path=None):
+    """Save a projection as .npz (to PROJECTION_PATH by default)."""
+    path = path or PROJECTION_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'wb') as f:
+        np.savez(f, method=projection['method'], whiten=projection['whiten'],
+                 mean=projection['mean'], components=projection['components'])
+    os.replace(f"{path}.tmp", path)
+
+def load_projection(path=None):
+    """Load a saved projection (from PROJECTION_PATH by default), or None if there isn't one."""
+    path = path or PROJECTION_PATH
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {
+            'method': str(data['method']),
+            'whiten': bool(data['whiten']),
+            'mean': data['mean'],
+            'components': data['components'],
+        }
+
+def evaluate_projection(projection, matrix, k=10, queries=200, rerank_factor=4, seed=0):
+    """
+    Compare reduced search against full-dimensional search, using sampled
+    stored embeddings as queries. Returns mean top-k overlap with and
+    without full-dimension re-ranking of the best rerank_factor * k candidates.
+    Each query's own row is left out of both result lists, since it is
+    trivially its own best match in either space.
+    """
+    rng = np.random.default_rng(seed)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    k = min(k, matrix.shape[0] - 1)
+    candidates = min(rerank_factor * k, matrix.shape[0] - 1)
+    reduced = project(projection, matrix)
+
+    overlap = []
+    reranked_overlap = []
+    for row in rng.choice(matrix.shape[0], min(queries, matrix.shape[0]), replace=False):
+        exact_scores = matrix @ matrix[row]
+        exact_scores[row] = -np.inf
+        exact = set(np.argpartition(-exact_scores, k - 1)[:k])
+
+        approx_scores = reduced @ reduced[row]
+        approx_scores[row] = -np.inf
+        approx = np.argpartition(-approx_scores, candidates - 1)[:candidates]
+        top_approx = approx[np.argsort(-approx_scores[approx])][:k]
+        top_reranked = approx[np.argsort(-exact_scores[approx])][:k]
+
+        overlap.append(len(exact.intersection(top_approx)) / k)
+        reranked_overlap.append(len(exact.intersection(top_reranked)) / k)
+
+    return {
+        'method': projection['method'],
+        'dim': projection['components'].shape[0],
+        'k': k,
+        'queries': len(overlap),
+        'overlap': float(np.mean(overlap)),
+        'reranked_overlap': float(np.mean(reranked_overlap)),
+        'compression': matrix.shape[1] / projection['components'].shape[0],
+    }
@@ -0,0 +1,248 @@
+"""
+Portable index snapshots in a versioned binary format.
+
+A snapshot file moves a whole index between hosts without going through
+row-per-image BLOBs. Layout:
+
+    MAGIC (8 bytes) | format version (uint32) | reserved (uint32)
+    sections, each aligned to SECTION_ALIGNMENT bytes
+    header (JSON: counts, generation, projection info and, per section,
+            offset, dtype, shape and SHA-256)
+    trailer: header offset (uint64) | header length (uint64) |
+             header SHA-256 (32 bytes) | MAGIC
+
+Sections are raw little-endian arrays, so they can be memory-mapped in
+place: the contiguous float32 embedding block, the filename (id) table,
+metadata columns, and optionally the region embeddings and the reduced
+vectors with the projection that produced them. String columns are
+stored as int64 offsets plus a UTF-8 blob, with a null mask where needed.
+"""
+
+import os
+import json
+import struct
+import hashlib
+from datetime import datetime
+import numpy as np
+
+from visioncop.database import get_image_records, replace_images
+from visioncop.index import get_index, install_snapshot
+from visioncop import reduction
+from visioncop.reduction import save_projection
+
+SNAPSHOT_MAGIC = b'VCSNAP\x00\x00'
+SNAPSHOT_VERSION = 1
+SECTION_ALIGNMENT = 64
+
+# Bytes hashed and written per step, so large mapped arrays stream through
+WRITE_CHUNK_BYTES = 64 * 1024 * 1024
+
+_PREAMBLE = struct.Struct('<8sII')
+_TRAILER = struct.Struct('<QQ32s8s')
+
+# Metadata columns carried alongside the embeddings
+STRING_COLUMNS = ['path', 'upload_date', 'source', 'phash', 'metadata']
+
+def _pack_strings(values):
+    """Pack a list of str/None into (int64 offsets, uint8 blob, null mask or None)."""
+    encoded = [value.encode('utf-8') if value is not None else b'' for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    nulls = np.array([value is None for value in values], dtype=bool)
+    return offsets, blob, nulls if nulls.any() else None
+
+def _unpack_strings(offsets, blob, nulls=None):
+    """Inverse of _pack_strings."""
+    data = blob.tobytes()
+    values = [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+    if nulls is not None:
+        for i in np.flatnonzero(nulls):
+            values[i] = None
+    return values
+
+def _add_strings(sections, name, values):
+    """Add a string column as its offsets/data(/nulls) sections."""
+    offsets, blob, nulls = _pack_strings(values)
+    sections[f'{name}.offsets'] = offsets
+    sections[f'{name}.data'] = blob
+    if nulls is not None:
+        sections[f'{name}.nulls'] = nulls
+
+def get_strings(snapshot, name):
+    """Decode a string column of a loaded snapshot."""
+    sections = snapshot['sections']
+    return _unpack_strings(sections[f'{name}.offsets'], sections[f'{name}.data'], sections.get(f'{name}.nulls'))
+
+def _chunks(array):
+    """Yield the raw bytes of an array in WRITE_CHUNK_BYTES pieces."""
+    flat = array.reshape(-1)
+    rows = max(1, WRITE_CHUNK_BYTES // max(1, array.dtype.itemsize))
+    for start in range(0, flat.shape[0], rows):
+        yield memoryview(np.ascontiguousarray(flat[start:start + rows])).cast('B')
+
+def _write_section(f, array):
+    """Append one aligned section and return its header entry."""
+    f.write(b'\0' * (-f.tell() % SECTION_ALIGNMENT))
+    offset = f.tell()
+    digest = hashlib.sha256()
+
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    for chunk in _chunks(array):
+        digest.update(chunk)
+        f.write(chunk)
+
+    return {
+        'offset': offset,
+        'dtype': array.dtype.str,
+        'shape': list(array.shape),
+        'sha256': digest.hexdigest(),
+    }
+
+def write_snapshot(path, sections, info):
+    """Atomically write named arrays and an info dict as a snapshot file."""
+    header = dict(info, version=SNAPSHOT_VERSION, sections={})
+
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0))
+        for name, array in sections.items():
+            header['sections'][name] = _write_section(f, np.asarray(array))
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_offset = f.tell()
+        f.write(header_bytes)
+        f.write(_TRAILER.pack(header_offset, len(header_bytes), hashlib.sha256(header_bytes).digest(), SNAPSHOT_MAGIC))
+
+    os.replace(f"{path}.tmp", path)
+    return header
+
+def read_snapshot(path, verify=True):
+    """
+    Open a snapshot file with every section memory-mapped read-only.
+    With verify, section checksums are checked (this reads the whole file).
+    Returns {'info': header, 'sections': {name: array}}.
+    Raises ValueError for files that are not valid snapshots.
+    """
+    size = os.path.getsize(path)
+    if size < _PREAMBLE.size + _TRAILER.size:
+        raise ValueError(f"{path} is too small to be a snapshot")
+
+    with open(path, 'rb') as f:
+        magic, version, _ = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a VisionCOP snapshot")
+        if version > SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot format {version} is newer than supported ({SNAPSHOT_VERSION})")
+
+        f.seek(size - _TRAILER.size)
+        header_offset, header_length, header_digest, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != SNAPSHOT_MAGIC or header_offset + header_length + _TRAILER.size != size:
+            raise ValueError(f"{path} is truncated")
+
+        f.seek(header_offset)
+        header_bytes = f.read(header_length)
+        if hashlib.sha256(header_bytes).digest() != header_digest:
+            raise ValueError(f"{path} has a corrupt header")
+        header = json.loads(header_bytes)
+
+    sections = {}
+    for name, entry in header['sections'].items():
+        shape = tuple(entry['shape'])
+        if 0 in shape:
+            array = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            array = np.memmap(path, dtype=entry['dtype'], mode='r', offset=entry['offset'], shape=shape)
+
+        if verify:
+            digest = hashlib.sha256()
+            for chunk in _chunks(array):
+                digest.update(chunk)
+            if digest.hexdigest() != entry['sha256']:
+                raise ValueError(f"Checksum mismatch in snapshot section '{name}'")
+
+        sections[name] = array
+
+    return {'info': header, 'sections': sections}
+
+def export_snapshot(path):
+    """
+    Export the current index (embeddings, filenames, metadata columns and,
+    when present, regions and reduced vectors) to a snapshot file.
+    Returns the written header.
+    """
+    # Compacted, so every row the index holds is in the mapped base snapshot
+    index = get_index(compact=True)
+    filenames = index['filenames'][:index['base_rows']]
+    records = get_image_records()
+    # Images added after the snapshot was written are left for the next export
+    rows = [records.get(filename) or {} for filename in filenames]
+
+    sections = {'embeddings': index['matrix']}
+    _add_strings(sections, 'filenames', filenames)
+    for column in STRING_COLUMNS:
+        _add_strings(sections, column, [row.get(column) for row in rows])
+    sections['cluster_id'] = np.array([row.get('cluster_id') if row.get('cluster_id') is not None else -1
+                                       for row in rows], dtype=np.int64)
+
+    if len(index['owners']):
+        sections['regions'] = index['regions']
+        sections['region_owners'] = index['owners']
+
+    info = {
+        'created': datetime.now().isoformat(),
+        'generation': index['generation'],
+        'count': len(filenames),
+        'dim': int(index['matrix'].shape[1]) if len(filenames) else 0,
+    }
+
+    projection = index['projection']
+    if projection is not None and index['reduced'] is not None:
+        sections['projection.mean'] = projection['mean']
+        sections['projection.components'] = projection['components']
+        sections['reduced'] = index['reduced']
+        info['projection'] = {'method': projection['method'], 'whiten': projection['whiten']}
+
+    return write_snapshot(path, sections, info)
+
+def import_snapshot(path, verify=True):
+    """
+    Replace the local index with a snapshot file: the database gets the
+    images and metadata in one transaction, and the mapped arrays are
+    installed as the new index snapshot so server workers pick them up
+    without rebuilding. Image files themselves are not part of a snapshot.
+    Returns the number of imported images.
+    """
+    snapshot = read_snapshot(path, verify=verify)
+    info = snapshot['info']
+    sections = snapshot['sections']
+
+    filenames = get_strings(snapshot, 'filenames')
+    columns = {column: get_strings(snapshot, column) for column in STRING_COLUMNS}
+    cluster_ids = sections['cluster_id'].tolist()
+    records = []
+    for i, filename in enumerate(filenames):
+        record = {column: values[i] for column, values in columns.items()}
+        record.update(filename=filename, cluster_id=cluster_ids[i] if cluster_ids[i] >= 0 else None)
+        records.append(record)
+
+    matrix = sections['embeddings']
+    regions = sections.get('regions', np.zeros((0, 0), dtype=np.float16))
+    owners = sections.get('region_owners', np.zeros(0, dtype=np.int32))
+    region_counts = np.bincount(owners, minlength=len(filenames)) if len(owners) else None
+
+    state = replace_images(records, matrix, region_counts, regions)
+    if state is None:
+        raise ValueError("Could not write the snapshot into the database")
+
+    projection = reduced = None
+    if 'projection' in info:
+        projection = dict(info['projection'], mean=np.array(sections['projection.mean']),
+                          components=np.array(sections['projection.components']))
+        reduced = sections['reduced']
+        save_projection(projection)
+    elif os.path.exists(reduction.PROJECTION_PATH):
+        # A local projection may not even match the imported dimension
+        os.remove(reduction.PROJECTION_PATH)
+
+    install_snapshot(state, filenames, matrix, regions, owners, projection, reduced)
+    return len(filenames)
@@ -0,0 +1,82 @@
+"""
+Import-time profiling for CLI startup.
+
+Each module is imported in a fresh interpreter with `python -X importtime`,
+so every number is a cold import. Heavy dependencies (torch, torchvision,
+cv2, imagehash, pandas, streamlit) should only show up under the
+subsystems that actually use them.
+"""
+
+import os
+import subprocess
+import sys
+
+# Modules imported by CLI commands, the API server and DB-only tools
+STARTUP_MODULES = [
+    'visioncop.database',
+    'visioncop.jobs',
+    'visioncop.index',
+    'visioncop.cache',
+    'visioncop.ingest',
+    'visioncop.verification',
+    'visioncop.dedup',
+    'visioncop.models',
+    'visioncop.app',
+]
+
+def _parse_importtime(stderr):
+    """Parse -X importtime output into [(module, self_us, cumulative_us, depth)]."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return entries
+
+def profile_import(module):
+    """
+    Cold-import one module and return {'module', 'total_ms', 'heaviest'},
+    where heaviest lists the top-level third-party packages it pulled in
+    as (package, cumulative_ms), slowest first.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, cwd=os.getcwd())
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        raise ImportError(error[-1] if error else f"could not import {module}")
+
+    entries = _parse_importtime(result.stderr)
+    # Skip interpreter startup (everything up to and including `site`)
+    site = next((i for i, (name, _, _, depth) in enumerate(entries) if name == 'site' and depth == 0), -1)
+    entries = entries[site + 1:]
+    total = next((cumulative for name, _, cumulative, _ in entries if name == module), 0)
+
+    # Collapse each import to its top-level package (torch.nn -> torch)
+    packages = {}
+    for name, _, cumulative, _ in entries:
+        package = name.split('.')[0]
+        if package != module.split('.')[0]:
+            packages[package] = max(packages.get(package, 0), cumulative)
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+    return {
+        'module': module,
+        'total_ms': total / 1000,
+        'heaviest': [(package, cumulative / 1000) for package, cumulative in heaviest],
+    }
+
+def profile_startup(modules=None, top=3):
+    """Print a cold import-time report for each module and return the results."""
+    results = []
+    for module in modules or STARTUP_MODULES:
+        try:
+            results.append(profile_import(module))
+        except ImportError as e:
+            print(f"❌ {module}: {e}")
+
+    for report in results:
+        heavy = ', '.join(f"{package} {ms:.0f}ms" for package, ms in report['heaviest'][:top])
+        print(f"📦 {report['module']:<24} {report['total_ms']:>7.0f} ms  ({heavy})")
+    return results
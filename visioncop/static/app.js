@@ -31,35 +31,37 @@ function initializeApp() {
         uploadBtn.disabled = true;
         uploadBtn.innerHTML = '<div class="loading"></div> Uploading...';
 
-        let successCount = 0;
-        let errorMessages = [];
-
-        for (let i = 0; i < files.length; i++) {
-            const file = files[i];
-            try {
-                const result = await uploadImage(file);
-                if (result.success) {
-                    successCount++;
-                } else {
-                    errorMessages.push(`${file.name}: ${result.message}`);
+        try {
+            const result = await uploadImages(files);
+            if (result.success) {
+                showStatus(uploadStatus, `Uploaded ${files.length - result.errors.length} image(s), indexing...`, 'warning');
+                const job = await pollJob(result.job_id, function(job) {
+                    const done = job.completed + job.failed;
+                    uploadBtn.innerHTML = `<div class="loading"></div> Indexing ${done}/${job.total} (${job.images_per_second} img/s)`;
+                });
+
+                if (job.status === 'queued' || job.status === 'running') {
+                    showStatus(uploadStatus, 'Images are queued but no index worker is making progress. ' +
+                        'Check the worker log for errors, or start one with: python run.py --index-workers 1', 'warning');
+                } else if (job.completed > 0) {
+                    showStatus(uploadStatus, `Successfully indexed ${job.completed} image(s)`, 'success');
+                    loadStats(); // Update stats
+                }
+                const errorMessages = result.errors.concat(job.errors);
+                if (errorMessages.length > 0) {
+                    showStatus(uploadStatus, 'Errors: ' + errorMessages.join('; '), 'error');
                 }
-            } catch (error) {
-                errorMessages.push(`${file.name}: ${error.message}`);
+            } else {
+                const errors = result.errors ? result.errors.join('; ') : '';
+                showStatus(uploadStatus, `${result.message}${errors ? ': ' + errors : ''}`, 'error');
             }
+        } catch (error) {
+            showStatus(uploadStatus, 'Upload failed: ' + error.message, 'error');
         }
 
         uploadBtn.disabled = false;
         uploadBtn.innerHTML = 'Upload & Index';
 
-        if (successCount > 0) {
-            showStatus(uploadStatus, `Successfully uploaded ${successCount} image(s)`, 'success');
-            loadStats(); // Update stats
-        }
-
-        if (errorMessages.length > 0) {
-            showStatus(uploadStatus, 'Errors: ' + errorMessages.join('; '), 'error');
-        }
-
         // Clear file input
         uploadFile.value = '';
     });
@@ -96,11 +98,13 @@ function initializeApp() {
     });
 }
 
-async function uploadImage(file) {
+async function uploadImages(files) {
     const formData = new FormData();
-    formData.append('file', file);
+    for (let i = 0; i < files.length; i++) {
+        formData.append('files', files[i]);
+    }
 
-    const response = await fetch('/upload', {
+    const response = await fetch('/jobs', {
         method: 'POST',
         body: formData
     });
@@ -108,6 +112,34 @@ async function uploadImage(file) {
     return await response.json();
 }
 
+async function pollJob(jobId, onProgress, stallTimeout = 60000) {
+    // Indexing runs in background workers; poll until the job finishes,
+    // or give up once its progress has not moved for stallTimeout ms
+    let lastProgress = null;
+    let lastChange = Date.now();
+
+    while (true) {
+        const response = await fetch(`/jobs/${jobId}`);
+        const job = await response.json();
+        if (job.error) {
+            throw new Error(job.error);
+        }
+
+        onProgress(job);
+        if (job.status === 'done' || job.status === 'failed') {
+            return job;
+        }
+
+        if (job.progress !== lastProgress) {
+            lastProgress = job.progress;
+            lastChange = Date.now();
+        } else if (Date.now() - lastChange > stallTimeout) {
+            return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 async function searchSimilar(file) {
     const formData = new FormData();
     formData.append('file', file);
@@ -162,7 +194,7 @@ function displayResults(results) {
         const similarityPercentage = (result.similarity * 100).toFixed(1);
 
         item.innerHTML = `
-            <img src="/images/${result.filename}" alt="${result.filename}" class="result-image" loading="lazy">
+            <img src="/images/${result.filename}?size=thumb" alt="${result.filename}" class="result-image" loading="lazy">
             <div class="result-info">
                 <div>${result.filename}</div>
                 <div class="similarity">${similarityPercentage}% similar</div>
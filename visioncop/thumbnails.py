@@ -0,0 +1,145 @@
+"""
+Resized derivative cache for image serving.
+
+Derivatives (thumbnail / preview, WebP or JPEG) are generated lazily on
+first request and stored on disk under a content-addressed key, so the
+same source bytes always map to the same file and the key doubles as an
+HTTP ETag. The cache is pruned least-recently-used when it grows past
+CACHE_MAX_BYTES.
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cache", "derivatives")
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Other server workers write to the same cache unseen, so each process
+# re-measures it from disk after writing this much itself
+RESCAN_BYTES = CACHE_MAX_BYTES // 16
+
+# Longest side in pixels for each derivative size; thumb covers the
+# 150px result tiles (Streamlit grids and the static frontend) with headroom
+SIZES = {
+    'thumb': 256,
+    'preview': 800,
+}
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+
+# Source digests keyed by (path, mtime, size), least recently used first
+MEMO_SIZE = 4096
+_digest_memo = OrderedDict()
+_lock = threading.Lock()
+_cache_bytes = None
+_unscanned_bytes = 0
+
+def _source_digest(source_path):
+    """Content hash of the source file, memoized on (path, mtime, size)."""
+    stat = os.stat(source_path)
+    memo_key = (source_path, stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        digest = _digest_memo.get(memo_key)
+        if digest is not None:
+            _digest_memo.move_to_end(memo_key)
+            return digest
+
+    hasher = hashlib.sha256()
+    with open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    with _lock:
+        _digest_memo[memo_key] = digest
+        if len(_digest_memo) > MEMO_SIZE:
+            _digest_memo.popitem(last=False)
+    return digest
+
+def derivative_key(source_path, size='thumb', fmt='webp'):
+    """Content-addressed cache key (also used as the ETag) for a derivative."""
+    return f"{_source_digest(source_path)[:32]}-{size}.{fmt}"
+
+def _cache_path(key):
+    """On-disk location for a cache key, sharded by its first two characters."""
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+def _prune_cache(new_bytes):
+    """Evict least-recently-used derivatives once the cache exceeds its limit."""
+    global _cache_bytes, _unscanned_bytes
+
+    with _lock:
+        _unscanned_bytes += new_bytes
+        if _cache_bytes is None or _unscanned_bytes >= RESCAN_BYTES:
+            _cache_bytes = None
+        else:
+            _cache_bytes += new_bytes
+
+        # Measure the shared cache from disk before deciding to evict, so
+        # derivatives written by other processes count toward the limit
+        if _cache_bytes is None or _cache_bytes > CACHE_MAX_BYTES:
+            _cache_bytes = sum(entry[2] for entry in _scan_cache())
+            _unscanned_bytes = 0
+
+        if _cache_bytes <= CACHE_MAX_BYTES:
+            return
+
+        # Hits refresh mtime, so oldest mtime is least recently used
+        for path, _, size in sorted(_scan_cache(), key=lambda entry: entry[1]):
+            if _cache_bytes <= CACHE_MAX_BYTES * 0.9:
+                break
+            try:
+                os.remove(path)
+                _cache_bytes -= size
+            except OSError:
+                pass
+
+def _scan_cache():
+    """Yield (path, mtime, size) for every cached derivative."""
+    for root, dirs, files in os.walk(CACHE_DIR):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_mtime, stat.st_size
+
+def get_derivative(source_path, size='thumb', fmt='webp'):
+    """
+    Get the path of a resized derivative, generating it on first use.
+    Returns (path, etag), or (None, None) if the source can't be processed.
+    """
+    try:
+        key = derivative_key(source_path, size, fmt)
+        path = _cache_path(key)
+
+        if os.path.exists(path):
+            os.utime(path)
+            return path, key
+
+        max_side = SIZES[size]
+        pil_format, _ = FORMATS[fmt]
+
+        img = Image.open(source_path)
+        # Let the JPEG decoder downscale via DCT before full decode
+        img.draft('RGB', (max_side, max_side))
+        img = img.convert('RGB')
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, format=pil_format, quality=85)
+        os.replace(tmp_path, path)
+
+        _prune_cache(os.path.getsize(path))
+        return path, key
+
+    except Exception as e:
+        print(f"Error creating {size} derivative for {source_path}: {e}")
+        return None, None
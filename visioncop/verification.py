@@ -1,18 +1,72 @@
-import imagehash
-import exifread
 from PIL import Image
 import os
-import cv2
 import numpy as np
 import io
-
-def verify_image_authenticity(query_image_path, original_candidate_path):
+from collections import OrderedDict
+
+# imagehash and cv2 are imported where they are used so that importing this
+# module (e.g. for extract_exif_record at upload time) stays cheap
+
+# Verification tiers, cheapest first; depth=N runs at most the first N
+VERIFICATION_TIERS = ['hash', 'dhash', 'metadata', 'manipulation']
+
+# Short-circuit thresholds (Hamming distance between 64-bit hashes)
+DIFFERENT_PHASH_DISTANCE = 30
+DIFFERENT_DHASH_DISTANCE = 30
+
+# Hashes and manipulation results are memoized per file version, so bulk
+# verification of one query against many candidates analyses the query once
+MEMO_SIZE = 4096
+_hash_memo = OrderedDict()
+_manipulation_memo = OrderedDict()
+
+def _memoized(memo, path, compute):
+    """Look up or compute a per-file result keyed by (path, mtime, size)."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key in memo:
+        memo.move_to_end(key)
+        return memo[key]
+
+    value = compute(path)
+    memo[key] = value
+    if len(memo) > MEMO_SIZE:
+        memo.popitem(last=False)
+    return value
+
+def _compute_hashes(image_path):
+    """pHash and dHash hex strings from one reduced-size decode."""
+    import imagehash
+
+    img = Image.open(image_path)
+    # Hashes work on 32x32 at most; let the JPEG decoder downscale
+    img.draft('RGB', (128, 128))
+    img = img.convert('RGB')
+    return {'phash': str(imagehash.phash(img)), 'dhash': str(imagehash.dhash(img))}
+
+def compute_image_hashes(image_path):
+    """Get memoized pHash and dHash hex strings for an image file."""
+    return _memoized(_hash_memo, image_path, _compute_hashes)
+
+def verify_image_authenticity(query_image_path, original_candidate_path, depth=None, original_hash=None, original_exif=None):
     """
     Comprehensive authenticity verification using multiple methods.
     Returns authenticity score and detailed analysis.
 
     This provides pixel-level and metadata-based authenticity verification.
+    Checks run cheapest first (VERIFICATION_TIERS) and stop as soon as the
+    outcome is settled: clearly different content skips EXIF and ELA, and
+    close pixels (pHash distance <= 15) without metadata issues skip
+    manipulation detection.
+    dHash is only computed for borderline pHash distances (16-30).
+    depth limits how many tiers may run; when it cuts the run short, the
+    verdict is that of the last tier that ran and early_exit names it.
+    original_hash (a stored pHash hex, e.g. from the dedup job) and
+    original_exif (the EXIF record stored at index time) spare reading the
+    candidate file.
     """
+    import imagehash
+
     results = {
         'pixel_distance': -1,
         'pixel_status': 'Verification Failed',
@@ -20,19 +74,20 @@ def verify_image_authenticity(query_image_path, original_candidate_path):
         'metadata_issues': [],
         'manipulation_score': 0,
         'manipulation_flags': [],
-        'overall_confidence': 'Unknown'
+        'overall_confidence': 'Unknown',
+        'tiers_run': [],
+        'early_exit': None
     }
 
+    tiers = VERIFICATION_TIERS[:max(1, len(VERIFICATION_TIERS) if depth is None else depth)]
+
     try:
-        # Load images
-        query_img = Image.open(query_image_path).convert('RGB')
-        original_img = Image.open(original_candidate_path).convert('RGB')
-
-        # 1. PERCEPTUAL HASHING (pHash)
-        query_hash = imagehash.phash(query_img)
-        original_hash = imagehash.phash(original_img)
-        pixel_distance = query_hash - original_hash
+        # 1. PERCEPTUAL HASHING (pHash), from the stored hash when available
+        query_hashes = compute_image_hashes(query_image_path)
+        original_phash = original_hash or compute_image_hashes(original_candidate_path)['phash']
+        pixel_distance = imagehash.hex_to_hash(query_hashes['phash']) - imagehash.hex_to_hash(original_phash)
         results['pixel_distance'] = pixel_distance
+        results['tiers_run'].append('hash')
 
         # Determine status based on pixel distance
         if pixel_distance == 0:
@@ -44,32 +99,68 @@ def verify_image_authenticity(query_image_path, original_candidate_path):
         elif pixel_distance <= 15:
             results['pixel_status'] = "High Similarity"
             results['overall_confidence'] = "Possibly Modified"
-        elif pixel_distance <= 30:
+        elif pixel_distance <= DIFFERENT_PHASH_DISTANCE:
             results['pixel_status'] = "Moderate Similarity"
             results['overall_confidence'] = "Significantly Modified"
         else:
             results['pixel_status'] = "Different Content"
             results['overall_confidence'] = "Different Image"
+            results['early_exit'] = 'hash'
+            return results
 
-        # 2. METADATA COMPARISON (EXIF)
-        metadata_results = compare_image_metadata(query_image_path, original_candidate_path)
+        # 2. GRADIENT HASH (dHash) as a second opinion on borderline matches only;
+        # below 15 pHash alone already says the content is the same
+        if 'dhash' in tiers and pixel_distance > 15:
+            original_dhash = compute_image_hashes(original_candidate_path)['dhash']
+            dhash_distance = imagehash.hex_to_hash(query_hashes['dhash']) - imagehash.hex_to_hash(original_dhash)
+            results['dhash_distance'] = dhash_distance
+            results['tiers_run'].append('dhash')
+
+            if dhash_distance > DIFFERENT_DHASH_DISTANCE:
+                results['pixel_status'] = "Different Content"
+                results['overall_confidence'] = "Different Image"
+                results['early_exit'] = 'dhash'
+                return results
+
+        # Capped before EXIF: the hash verdict stands
+        if 'metadata' not in tiers:
+            results['early_exit'] = results['tiers_run'][-1]
+            return results
+
+        # 3. METADATA COMPARISON (EXIF)
+        metadata_results = compare_image_metadata(query_image_path, original_candidate_path, original_exif)
         results['metadata_match'] = metadata_results['match']
         results['metadata_issues'] = metadata_results['issues']
+        results['tiers_run'].append('metadata')
 
-        # 3. MANIPULATION DETECTION
-        manip_results = detect_image_manipulation(query_image_path)
-        results['manipulation_score'] = manip_results['score']
-        results['manipulation_flags'] = manip_results['flags']
-
-        # Final determination
         if pixel_distance == 0 and metadata_results['match']:
             results['overall_confidence'] = "Perfectly Authentic"
-        elif pixel_distance <= 15 and not metadata_results['issues']:
+            results['early_exit'] = 'metadata'
+            return results
+
+        # Same content with consistent metadata: the verdict below cannot
+        # depend on the manipulation score, so skip ELA
+        if pixel_distance <= 15 and not metadata_results['issues']:
             results['overall_confidence'] = "Likely Authentic/Reused"
-        elif manip_results['score'] > 0.7:
+            results['early_exit'] = 'metadata'
+            return results
+
+        # Capped before ELA: metadata issues override the hash verdict
+        if 'manipulation' not in tiers:
+            if metadata_results['issues']:
+                results['overall_confidence'] = "Metadata Mismatch"
+            results['early_exit'] = 'metadata'
+            return results
+
+        # 4. MANIPULATION DETECTION
+        manip_results = _memoized(_manipulation_memo, query_image_path, detect_image_manipulation)
+        results['manipulation_score'] = manip_results['score']
+        results['manipulation_flags'] = manip_results['flags']
+        results['tiers_run'].append('manipulation')
+
+        # Final determination (every tier ran)
+        if manip_results['score'] > 0.7:
             results['overall_confidence'] = "Definitely Manipulated"
-        elif pixel_distance > 30:
-            results['overall_confidence'] = "Different Image"
         elif metadata_results['issues']:
             results['overall_confidence'] = "Metadata Mismatch"
         else:
@@ -82,38 +173,82 @@ def verify_image_authenticity(query_image_path, original_candidate_path):
         results['overall_confidence'] = "Verification Failed"
         return results
 
-def compare_image_metadata(query_path, original_path):
-    """Compare EXIF metadata between two images."""
+# Compared EXIF fields: the first name labels the issue, and the first name
+# present on the original is the tag that gets compared
+KEY_EXIF_FIELDS = [
+    ('Image DateTime', 'EXIF DateTimeOriginal'),
+    ('Image Width', 'EXIF ExifImageWidth'),
+    ('Image Height', 'EXIF ExifImageLength'),
+    ('Camera Make', 'Image Make'),
+    ('Camera Model', 'Image Model'),
+    ('Software', 'Image Software')
+]
+
+# Location of each compared tag as (sub-IFD pointer or None for IFD0, tag id)
+EXIF_TAG_LOCATIONS = {
+    'Image DateTime': (None, 0x0132),
+    'EXIF DateTimeOriginal': (0x8769, 0x9003),
+    'EXIF ExifImageWidth': (0x8769, 0xA002),
+    'EXIF ExifImageLength': (0x8769, 0xA003),
+    'Image Make': (None, 0x010F),
+    'Image Model': (None, 0x0110),
+    'Image Software': (None, 0x0131),
+}
+
+_exif_memo = OrderedDict()
+
+def _normalize_exif_value(value):
+    """Render an EXIF value as a comparable string."""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    return str(value).strip('\x00 ')
+
+def extract_exif_record(image_source):
+    """
+    Read only the compared EXIF tags (IFD0 and the Exif sub-IFD) without
+    decoding pixels or parsing maker notes, GPS or thumbnails. Returns a
+    compact {tag name: string} record that can be stored at index time.
+    """
+    with Image.open(image_source) as img:
+        exif = img.getexif()
+        exif_ifd = exif.get_ifd(0x8769) if 0x8769 in exif else {}
+
+    record = {}
+    for name, (ifd, tag) in EXIF_TAG_LOCATIONS.items():
+        value = (exif_ifd if ifd else exif).get(tag)
+        if value is not None:
+            record[name] = _normalize_exif_value(value)
+    return record
+
+def compare_exif_records(query_record, original_record):
+    """Compare two EXIF records from extract_exif_record (no file I/O)."""
+    results = {'match': True, 'issues': []}
+
+    for field in KEY_EXIF_FIELDS:
+        for field_name in field:
+            if field_name in original_record:
+                original_value = original_record[field_name]
+                query_value = query_record.get(field_name, 'Missing')
+
+                if original_value != query_value:
+                    results['issues'].append(f"{field[0]}: {original_value} → {query_value}")
+                    results['match'] = False
+                break
+
+    return results
+
+def compare_image_metadata(query_path, original_path, original_record=None):
+    """
+    Compare EXIF metadata between two images. original_record (e.g. stored
+    at index time) avoids reading the original file.
+    """
     results = {'match': True, 'issues': []}
 
     try:
-        with open(query_path, 'rb') as f1, open(original_path, 'rb') as f2:
-            query_tags = exifread.process_file(f1, details=False)
-            original_tags = exifread.process_file(f2, details=False)
-
-        # Check key metadata fields
-        key_fields = [
-            ('Image DateTime', 'EXIF DateTimeOriginal'),
-            ('Image Width', 'EXIF ExifImageWidth'),
-            ('Image Height', 'EXIF ExifImageLength'),
-            ('Camera Make', 'Image Make'),
-            ('Camera Model', 'Image Model'),
-            ('Software', 'Image Software')
-        ]
-
-        for field in key_fields:
-            for field_name in field:
-                if field_name in original_tags:
-                    original_value = str(original_tags[field_name])
-                    query_value = str(query_tags.get(field_name, 'Missing'))
-
-                    if original_value != query_value:
-                        results['issues'].append(f"{field[0]}: {original_value} → {query_value}")
-                        results['match'] = False
-                    break
-
-        if results['issues']:
-            results['match'] = False
+        query_record = _memoized(_exif_memo, query_path, extract_exif_record)
+        if original_record is None:
+            original_record = _memoized(_exif_memo, original_path, extract_exif_record)
+        results = compare_exif_records(query_record, original_record)
 
     except Exception as e:
         results['issues'].append(f"Metadata read error: {e}")
@@ -122,6 +257,8 @@ def compare_image_metadata(query_path, original_path):
 
 def detect_image_manipulation(image_path):
     """Detect signs of image manipulation."""
+    import cv2
+
     results = {'score': 0.0, 'flags': []}
 
     try:
@@ -200,9 +337,10 @@ def get_verification_status(results_dict):
 
 def calculate_image_hash(image_path):
     """Calculate perceptual hash for an image file."""
+    import imagehash
+
     try:
-        img = Image.open(image_path)
-        phash = imagehash.phash(img)
+        phash = imagehash.hex_to_hash(compute_image_hashes(image_path)['phash'])
         return phash
     except Exception as e:
         print(f"Error calculating hash for {image_path}: {e}")